@@ -0,0 +1,252 @@
+# Endpoint benchmarks with MongoDB command budgets.
+#
+# Seeds a jService-sized synthetic dataset, drives every endpoint through
+# FastAPI's TestClient and reports latency percentiles, throughput and
+# MongoDB commands per request. Exits non-zero when any endpoint issues
+# more commands per request than its budget, so N+1 regressions fail.
+#
+#     python -m benchmarks                         # in-memory (mongomock)
+#     python -m benchmarks --mongo-url mongodb://localhost:27017
+#     python -m benchmarks --scale 0.1 --requests 20 --only clues
+#     python -m benchmarks --postgres-url postgresql://localhost/bench
+#     python -m benchmarks --catalog /tmp/bench-clues.cat
+#     python -m benchmarks --driver async
+#
+# The in-memory stand-in counts the collection calls the routers make,
+# which map one to one onto server commands; its latencies only compare
+# runs with each other. Against a real mongod every command the driver
+# sends is counted through a CommandListener.
+#
+# With --postgres-url the routes in routers/pg.py are served from that
+# database, seeded with the same data, so the two backends can be compared
+# endpoint by endpoint. Only MongoDB commands count against the budgets.
+#
+# With --catalog the clue catalog (catalog.py) is built from the seeded
+# data into that file and mapped before the requests, so the clue reads it
+# serves show up with no commands at all.
+#
+# With --driver async the read routes in routers/aio.py are served with
+# Motor (in memory, mongomock-motor over the same data), counted the same
+# way, so the two drivers can be compared under the same budgets.
+from benchmarks.commands import CommandCounter, in_memory_client
+import anyio
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault('MONGOHOST', 'localhost')
+os.environ.setdefault('MONGODATABASE', 'trivia-game')
+os.environ.setdefault('MONGOUSER', 'trivia-game')
+os.environ.setdefault('MONGOPASSWORD', 'trivia-game')
+
+# Highest number of MongoDB commands one request may issue. Each endpoint
+# gets one warm-up request, then the in-process caches are cleared before
+# every measured request so a cache cannot hide an N+1.
+BUDGETS = {
+    "GET /api/clues": 2,
+    "GET /api/clues?after": 2,
+    "GET /api/clues/{id}": 1,
+    "GET /api/clues/search": 1,
+    "POST /api/clues/batch": 1,
+    "GET /api/random-clue": 4,
+    "GET /api/random-clue?valid=false": 1,
+    "GET /api/categories": 3,
+    "GET /api/categories?after": 3,
+    "GET /api/categories/{id}": 1,
+    "GET /api/games": 3,
+    "GET /api/games/{id}": 2,
+    "POST /api/custom-games": 1,
+    "GET /api/custom-games/{id}": 3,
+    "POST /api/categories": 2,
+    "PUT /api/categories/{id}": 1,
+    "PUT /api/clues/{id}": 3,
+}
+
+# Budgets that differ with --catalog: a category change bumps the
+# catalog's generation and a clue's first flag is published to the other
+# workers, one command each.
+CATALOG_BUDGETS = {
+    "PUT /api/categories/{id}": 2,
+    "PUT /api/clues/{id}": 4,
+}
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def scenarios(db, client, server, requests):
+    clue = db.clues.find_one({"invalid_count": 0})
+    # A valid clue for every flag, so each request pays for a first flag;
+    # from the far end of the ids, away from the clue read above.
+    flag_ids = [doc["_id"] for doc in db.clues.find({"invalid_count": 0}, {"_id": 1}).sort("_id", -1).limit(requests + 1)]
+    category = db.categories.find_one()
+    game = db.games.find_one()
+    batch_ids = [str(doc["_id"]) for doc in db.clues.find({}, {"_id": 1}).limit(100)]
+    clues_cursor = client.get("/api/clues", params={"page": 5}).json()["next_cursor"]
+    categories_cursor = client.get("/api/categories", params={"page": 3}).json()["next_cursor"]
+    # Endpoints that read what an earlier one created; --only may skip
+    # the creating endpoint, so start with one of each.
+    custom_games = [client.post("/api/custom-games").json()["id"]]
+    categories = [client.post("/api/categories", json={"title": "bench"}).json()["id"]]
+
+    def create_custom_game(client):
+        response = client.post("/api/custom-games")
+        custom_games.append(response.json()["id"])
+        return response
+
+    def create_category(client):
+        response = client.post("/api/categories", json={"title": f"bench {len(categories)}"})
+        categories.append(response.json()["id"])
+        return response
+
+    server_only = []
+    if server:
+        # mongomock has no $text.
+        server_only.append(
+            ("GET /api/clues/search", lambda client: client.get("/api/clues/search", params={"q": "river opera"})),
+        )
+    return server_only + [
+        ("GET /api/clues", lambda client: client.get("/api/clues", params={"page": 5})),
+        ("GET /api/clues?after", lambda client: client.get("/api/clues", params={"after": clues_cursor})),
+        ("GET /api/clues/{id}", lambda client: client.get(f"/api/clues/{clue['_id']}")),
+        ("POST /api/clues/batch", lambda client: client.post("/api/clues/batch", json={"ids": batch_ids})),
+        ("GET /api/random-clue", lambda client: client.get("/api/random-clue")),
+        ("GET /api/random-clue?valid=false", lambda client: client.get("/api/random-clue", params={"valid": False})),
+        ("GET /api/categories", lambda client: client.get("/api/categories", params={"page": 3})),
+        ("GET /api/categories?after", lambda client: client.get("/api/categories", params={"after": categories_cursor})),
+        ("GET /api/categories/{id}", lambda client: client.get(f"/api/categories/{category['_id']}")),
+        ("GET /api/games", lambda client: client.get("/api/games", params={"page": 1})),
+        ("GET /api/games/{id}", lambda client: client.get(f"/api/games/{game['_id']}")),
+        ("POST /api/custom-games", create_custom_game),
+        ("GET /api/custom-games/{id}", lambda client: client.get(f"/api/custom-games/{custom_games[-1]}")),
+        ("POST /api/categories", create_category),
+        ("PUT /api/categories/{id}", lambda client: client.put(f"/api/categories/{categories[-1]}", json={"title": "renamed"})),
+        ("PUT /api/clues/{id}", lambda client: client.put(f"/api/clues/{flag_ids.pop()}")),
+    ]
+
+
+def run(args):
+    import database
+
+    # Seeding drops collections, so never run against the app's database.
+    database.dbname = args.database
+    counter = CommandCounter()
+    if args.mongo_url:
+        import pymongo
+        database.client = pymongo.MongoClient(args.mongo_url, event_listeners=[counter, database.pool_stats])
+    else:
+        database.client = in_memory_client(counter)
+    if args.driver == "async":
+        # Before main is imported, so it registers the async routes.
+        database.driver = "async"
+        if args.mongo_url:
+            from motor.motor_asyncio import AsyncIOMotorClient
+            database.async_client = AsyncIOMotorClient(args.mongo_url, event_listeners=[counter, database.pool_stats])
+        else:
+            from mongomock_motor import AsyncMongoMockClient
+            database.async_client = AsyncMongoMockClient(mock_mongo_client=database.client)
+
+    from benchmarks.seed import seed, seed_postgres
+    from fastapi.testclient import TestClient
+    from indexes import ensure_indexes, ensure_pg_indexes
+    from sampling import valid_clues
+
+    db = database.get_db()
+    started = time.perf_counter()
+    seed(db, scale=args.scale)
+    ensure_indexes(db)
+    valid_clues.refresh(db)
+    if args.postgres_url:
+        # Before main is imported, so it registers the Postgres routes.
+        database.backend = "postgres"
+        with database.connect_pg(args.postgres_url).connection() as conn:
+            seed_postgres(conn, scale=args.scale)
+            ensure_pg_indexes(conn)
+    print(f"seeded {db.clues.estimated_document_count()} clues in {time.perf_counter() - started:.1f}s")
+    if args.catalog:
+        import catalog
+        catalog.enabled = True
+        catalog.path = args.catalog
+        started = time.perf_counter()
+        catalog.build(db, catalog.path)
+        catalog.load()
+        print(f"mapped a {os.path.getsize(catalog.path)} byte catalog in {time.perf_counter() - started:.1f}s")
+    import main
+
+    # No context manager: startup would start background threads whose
+    # commands would be counted against the requests. The requests share
+    # one event loop, as in a server, since Motor binds to the first loop
+    # it is used on.
+    client = TestClient(main.app)
+    with anyio.start_blocking_portal() as client.portal:
+        failed = measure(args, db, client, counter)
+    database.close()
+    for failure in failed:
+        print(f"FAIL {failure}")
+    return 1 if failed else 0
+
+
+def measure(args, db, client, counter):
+    from routers.categories import category_cache
+    from routers.games import build_custom_game
+    import counters
+    import game_pool
+
+    failed = []
+    print(f"{'endpoint':34} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'cmds':>5} {'budget':>6}")
+    for name, request in scenarios(db, client, bool(args.mongo_url), args.requests):
+        if args.only and args.only not in name:
+            continue
+        request(client)
+        latencies = []
+        commands = []
+        for _ in range(args.requests):
+            category_cache.clear()
+            counters.invalidate()
+            # What the producer thread would do between requests, so
+            # custom games are claimed from the pool.
+            game_pool.fill(db, build_custom_game)
+            before = counter.count
+            started = time.perf_counter()
+            response = request(client)
+            latencies.append((time.perf_counter() - started) * 1000)
+            commands.append(counter.count - before)
+            if response.status_code >= 400:
+                failed.append(f"{name}: HTTP {response.status_code}")
+                break
+        # Over the time spent in requests only, not in the cache clearing
+        # and pool refills between them.
+        total = sum(latencies) / 1000
+        budget = CATALOG_BUDGETS.get(name, BUDGETS[name]) if args.catalog else BUDGETS[name]
+        worst = max(commands)
+        if worst > budget:
+            failed.append(f"{name}: {worst} commands per request, budget {budget}")
+        print(f"{name:34} {percentile(latencies, 50):8.2f} {percentile(latencies, 95):8.2f} "
+              f"{percentile(latencies, 99):8.2f} {len(latencies) / total:8.1f} {worst:5} {budget:6}"
+              f"{'  OVER' if worst > budget else ''}")
+    return failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--mongo-url", help="benchmark a real mongod instead of the in-memory stand-in")
+    parser.add_argument("--database", default="trivia-game-bench", help="database to seed, it is dropped first")
+    parser.add_argument("--postgres-url", help="serve the Postgres routes from this database; "
+                        "its clues, categories and games tables are dropped and reseeded")
+    parser.add_argument("--driver", choices=["sync", "async"], default="sync",
+                        help="serve the read routes with pymongo or with Motor (MONGO_DRIVER)")
+    parser.add_argument("--catalog", metavar="PATH", help="build the clue catalog into this file and serve from it")
+    parser.add_argument("--scale", type=float, help="fraction of the jService dataset size "
+                        "(default 1 against mongod, 0.02 in memory)")
+    parser.add_argument("--requests", type=int, default=50, help="requests per endpoint")
+    parser.add_argument("--only", help="run endpoints whose name contains this")
+    args = parser.parse_args(argv)
+    if args.scale is None:
+        args.scale = 1.0 if args.mongo_url else 0.02
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
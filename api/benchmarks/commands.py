@@ -0,0 +1,72 @@
+# MongoDB command counting, for the benchmark budgets and the tests.
+#
+# CommandCounter counts the commands a real mongod is sent, through
+# pymongo's monitoring; in_memory_client() returns a mongomock client that
+# counts the collection calls standing in for them.
+from pymongo import monitoring
+import threading
+
+IGNORED_COMMANDS = {"hello", "isMaster", "ismaster", "endSessions", "ping", "saslStart", "saslContinue"}
+
+
+class CommandCounter(monitoring.CommandListener):
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name not in IGNORED_COMMANDS:
+            with self._lock:
+                self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def in_memory_client(counter):
+    # mongomock speaks the pymongo API but has no monitoring; count each
+    # collection call that maps onto a command.
+    import mongomock
+    from mongomock.collection import Collection
+
+    depth = threading.local()
+
+    def counted(method):
+        def wrapper(self, *args, **kwargs):
+            outer = getattr(depth, "n", 0) == 0
+            if outer:
+                with counter._lock:
+                    counter.count += 1
+            depth.n = getattr(depth, "n", 0) + 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                depth.n -= 1
+        return wrapper
+
+    aggregate = Collection.aggregate
+
+    def aggregate_merge(self, pipeline, *args, **kwargs):
+        # mongomock has no $merge; run the rest and upsert what it yields.
+        if not pipeline or "$merge" not in pipeline[-1]:
+            return aggregate(self, pipeline, *args, **kwargs)
+        merge = pipeline[-1]["$merge"]
+        target = self.database[merge["into"]]
+        for doc in aggregate(self, pipeline[:-1], *args, **kwargs):
+            if merge.get("whenMatched") == "merge":
+                target.update_one({"_id": doc["_id"]}, {"$set": doc}, upsert=merge.get("whenNotMatched") != "discard")
+            else:
+                target.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+        return iter(())
+
+    Collection.aggregate = aggregate_merge
+    for name in ("find", "find_one", "aggregate", "insert_one", "insert_many", "update_one",
+                 "update_many", "delete_one", "delete_many", "find_one_and_update",
+                 "find_one_and_delete", "bulk_write", "count_documents",
+                 "estimated_document_count", "create_indexes", "distinct"):
+        setattr(Collection, name, counted(getattr(Collection, name)))
+    return mongomock.MongoClient()
@@ -0,0 +1,78 @@
+# Synthetic data with the shape and size of the jService dump: about 18k
+# categories, 350k clues and 3.6k games, with ~1% of clues flagged and
+# ~60% canon.
+from datetime import date, timedelta
+import random
+
+JSERVICE = {"categories": 18400, "clues": 350000, "games": 3640}
+
+
+def documents(scale=1.0, seed=0):
+    rng = random.Random(seed)
+    n_categories = max(1, int(JSERVICE["categories"] * scale))
+    n_clues = max(1, int(JSERVICE["clues"] * scale))
+    n_games = max(1, int(JSERVICE["games"] * scale))
+    words = ["river", "opera", "kings", "science", "potpourri", "capitals", "poets",
+             "rhyme time", "before & after", "world history", "anatomy", "food"]
+    categories = [
+        {"_id": i, "title": f"{rng.choice(words)} {i % 500}", "canon": True}
+        for i in range(1, n_categories + 1)
+    ]
+    aired = date(1984, 9, 10)
+    games = [
+        {"_id": i, "episode_id": i, "aired": str(aired + timedelta(days=i)), "canon": True}
+        for i in range(1, n_games + 1)
+    ]
+    clues = [
+        {
+            "_id": i,
+            "answer": f"answer {i}",
+            "question": f"This {rng.choice(words)} clue number {i} is about {rng.choice(words)}",
+            "value": rng.choice([200, 400, 600, 800, 1000]),
+            "invalid_count": 1 if rng.random() < 0.01 else 0,
+            "canon": rng.random() < 0.6,
+            "category_id": rng.randint(1, n_categories),
+            "game_id": rng.randint(1, n_games),
+        }
+        for i in range(1, n_clues + 1)
+    ]
+    for clue in clues:
+        category = categories[clue["category_id"] - 1]
+        clue["category"] = {"id": str(category["_id"]), "title": category["title"], "canon": category["canon"], "version": 0}
+    return {"categories": categories, "clues": clues, "games": games}
+
+
+def seed(db, scale=1.0, batch_size=10000):
+    for name, docs in documents(scale).items():
+        db[name].drop()
+        for start in range(0, len(docs), batch_size):
+            db[name].insert_many(docs[start:start + batch_size], ordered=False)
+    for name in ("game_definitions", "game_definition_clues", "counters", "game_stats"):
+        db[name].drop()
+
+
+# The jService tables as routers/pg.py reads them.
+PG_TABLES = {
+    "categories": ("id serial PRIMARY KEY, title text NOT NULL, canon boolean",
+                   ("id", "title", "canon")),
+    "games": ("id serial PRIMARY KEY, episode_id integer, aired date, canon boolean",
+              ("id", "episode_id", "aired", "canon")),
+    "clues": ("id serial PRIMARY KEY, answer text, question text, value integer, invalid_count integer, "
+              "canon boolean, category_id integer REFERENCES categories, game_id integer REFERENCES games",
+              ("id", "answer", "question", "value", "invalid_count", "canon", "category_id", "game_id")),
+}
+
+
+def seed_postgres(conn, scale=1.0):
+    # The same documents as seed(), so both backends serve the same ids.
+    docs = documents(scale)
+    conn.execute("DROP TABLE IF EXISTS clues, categories, games")
+    for table, (columns, fields) in PG_TABLES.items():
+        conn.execute(f"CREATE TABLE {table} ({columns})")
+        with conn.cursor().copy(f"COPY {table} ({', '.join(fields)}) FROM STDIN") as copy:
+            for doc in docs[table]:
+                copy.write_row([doc["_id"] if field == "id" else doc[field] for field in fields])
+        # Rows came with their ids; later inserts continue after them.
+        conn.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), max(id)) FROM {table}")
+        conn.execute(f"ANALYZE {table}")
+    conn.commit()
@@ -0,0 +1,395 @@
+# Read-only clue catalog in a memory-mapped snapshot file, opt in with
+# CATALOG=1.
+#
+# The file holds every clue with an integer id and its category as typed
+# columns: ids sorted for binary search, fixed-width numbers, and the
+# answers, questions and titles as UTF-8 blobs with offset arrays. Every
+# worker mmaps the same file read-only, so the page cache holds one copy
+# however many workers there are. get_clue, get_random_clue and custom-game
+# sampling are served from it and go to MongoDB only for what it lacks.
+#
+# Flagging a clue hides it from the catalog at once in the worker that
+# flags it (forget(), before the write) and records it in the catalog
+# collection (publish(), after it). Every CATALOG_CHECK_SECONDS each worker
+# picks up the clues flagged elsewhere, so those go to MongoDB too. Category
+# changes bump a generation counter instead (touch()).
+#
+# When the generation is ahead of the file, or CATALOG_REBUILD_FLAGS clues
+# are hidden, one worker at a time (under a file lock) rebuilds it, at most
+# every CATALOG_MIN_REBUILD_SECONDS. The new file is written next to the
+# old one and renamed over it, and every worker maps it on its next check.
+# Readers still holding the old mapping finish with it undisturbed.
+#
+#     python -m catalog          # build the file once, e.g. before deploy
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import fcntl
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+import time
+
+enabled = os.environ.get('CATALOG', '0') == '1'
+path = os.environ.get('CATALOG_PATH', '/tmp/trivia-catalog/clues.cat')
+check_seconds = float(os.environ.get('CATALOG_CHECK_SECONDS', 5))
+min_rebuild_seconds = float(os.environ.get('CATALOG_MIN_REBUILD_SECONDS', 60))
+rebuild_flags = int(os.environ.get('CATALOG_REBUILD_FLAGS', 1000))
+# A flag recorded this long before a build started is in the file.
+SLACK_SECONDS = 10
+
+MAGIC = b"CLUECAT1"
+# Columns in file order, with their array typecodes. "B" blobs are UTF-8.
+SECTIONS = [
+    ("clue_ids", "q"),
+    ("clue_values", "i"),
+    ("clue_invalid_counts", "i"),
+    ("clue_versions", "i"),
+    # Seconds since the epoch, 0 for never updated.
+    ("clue_updated_on", "d"),
+    ("clue_categories", "i"),
+    ("clue_canon", "B"),
+    ("answer_offsets", "Q"),
+    ("question_offsets", "Q"),
+    ("clue_text", "B"),
+    ("category_ids", "q"),
+    ("category_canon", "B"),
+    ("category_versions", "i"),
+    ("title_offsets", "Q"),
+    ("category_text", "B"),
+    # Positions of valid and of canon clues, for uniform sampling.
+    ("valid_positions", "i"),
+    ("canon_positions", "i"),
+]
+# magic, generation, time the build started, then (offset, length) of
+# every section.
+HEADER = struct.Struct("<8sQd" + "QQ" * len(SECTIONS))
+
+_lock = threading.Lock()
+_current = None
+# clue _id -> time it was flagged, for clues to read from MongoDB
+_forgotten = {}
+_polled = 0
+_stop = threading.Event()
+_thread = None
+stats = {"hits": 0, "misses": 0, "builds": 0, "loads": 0}
+EPOCH = datetime(1970, 1, 1)
+
+
+class Catalog:
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = HEADER.unpack_from(self._map)
+        if fields[0] != MAGIC:
+            raise ValueError(f"{filename} is not a clue catalog")
+        self.generation = fields[1]
+        self.built_at = fields[2]
+        view = memoryview(self._map)
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = fields[3 + 2 * i], fields[4 + 2 * i]
+            # Zero copy: typed views straight onto the mapped pages.
+            setattr(self, name, view[offset:offset + length].cast(typecode))
+
+    def __len__(self):
+        return len(self.clue_ids)
+
+    def position(self, clue_id):
+        i = bisect_left(self.clue_ids, clue_id)
+        if i < len(self.clue_ids) and self.clue_ids[i] == clue_id:
+            return i
+        return None
+
+    def clue(self, i):
+        # The clue at position i, shaped like a clue document with its
+        # embedded category snapshot.
+        c = self.clue_categories[i]
+        category_id = self.category_ids[c]
+        clue = {
+            "_id": self.clue_ids[i],
+            "answer": str(self.clue_text[self.answer_offsets[i]:self.answer_offsets[i + 1]], "utf-8"),
+            "question": str(self.clue_text[self.question_offsets[i]:self.question_offsets[i + 1]], "utf-8"),
+            "value": self.clue_values[i],
+            "invalid_count": self.clue_invalid_counts[i],
+            "canon": bool(self.clue_canon[i]),
+            "version": self.clue_versions[i],
+            "category_id": category_id,
+            "category": {
+                "id": str(category_id),
+                "title": str(self.category_text[self.title_offsets[c]:self.title_offsets[c + 1]], "utf-8"),
+                "canon": bool(self.category_canon[c]),
+                "version": self.category_versions[c],
+            },
+        }
+        if self.clue_updated_on[i]:
+            clue["updated_on"] = EPOCH + timedelta(seconds=self.clue_updated_on[i])
+        return clue
+
+
+def visible(clue_id):
+    return clue_id not in _forgotten
+
+
+def find(clue_id):
+    # The catalog's copy of a clue, or None when MongoDB has to be asked.
+    catalog = _current
+    if catalog is None or not isinstance(clue_id, int) or not visible(clue_id):
+        return None
+    i = catalog.position(clue_id)
+    if i is None:
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    return catalog.clue(i)
+
+
+def random_valid():
+    catalog = _current
+    if catalog is None or not len(catalog.valid_positions):
+        return None
+    for _ in range(3):
+        clue = catalog.clue(random.choice(catalog.valid_positions))
+        if visible(clue["_id"]):
+            return clue
+    return None
+
+
+def sample_canon(size):
+    # size distinct canon clues, or None to fall back to $sample.
+    catalog = _current
+    if catalog is None or len(catalog.canon_positions) < size:
+        return None
+    clues = [catalog.clue(catalog.canon_positions[i]) for i in random.sample(range(len(catalog.canon_positions)), size)]
+    if not all(visible(clue["_id"]) for clue in clues):
+        return None
+    return clues
+
+
+def forget(clue_ids):
+    # Called before flagging clues, so this worker stops serving them from
+    # the catalog before the write lands.
+    catalog = _current
+    if catalog is None:
+        return
+    now = time.time()
+    with _lock:
+        for clue_id in clue_ids:
+            i = catalog.position(clue_id) if isinstance(clue_id, int) else None
+            if i is not None and catalog.clue_invalid_counts[i] == 0:
+                _forgotten[clue_id] = now
+
+
+def publish(db, clue_ids):
+    # Called after clues became invalid, for the other workers to forget.
+    if enabled and clue_ids:
+        db.catalog.insert_one({"clues": list(clue_ids), "at": time.time()})
+
+
+def touch(db):
+    # Called after a category change; the next rebuild picks it up.
+    if enabled:
+        db.catalog.update_one({"_id": "generation"}, {"$inc": {"n": 1}}, upsert=True)
+
+
+def generation(db):
+    doc = db.catalog.find_one({"_id": "generation"})
+    return doc["n"] if doc else 0
+
+
+def build(db, filename=path):
+    # Read before the scan, so changes made during it trigger another build.
+    built_generation = generation(db)
+    started = time.time()
+    categories = {}
+    category_ids = array("q")
+    category_canon = array("B")
+    category_versions = array("i")
+    title_offsets = array("Q", [0])
+    category_text = bytearray()
+    for category in db.categories.find({}, {"title": 1, "canon": 1, "version": 1}).sort("_id"):
+        if not isinstance(category["_id"], int):
+            continue
+        categories[category["_id"]] = len(category_ids)
+        category_ids.append(category["_id"])
+        category_canon.append(bool(category.get("canon")))
+        category_versions.append(category.get("version", 0))
+        category_text += (category.get("title") or "").encode()
+        title_offsets.append(len(category_text))
+
+    columns = {name: array(typecode) for name, typecode in SECTIONS[:9]}
+    columns["answer_offsets"].append(0)
+    clue_text = bytearray()
+    questions = bytearray()
+    question_offsets = [0]
+    valid_positions = array("i")
+    canon_positions = array("i")
+    fields = {"answer": 1, "question": 1, "value": 1, "invalid_count": 1, "canon": 1, "category_id": 1,
+              "version": 1, "updated_on": 1}
+    for clue in db.clues.find({}, fields).sort("_id").batch_size(5000):
+        c = categories.get(clue.get("category_id"))
+        if not isinstance(clue["_id"], int) or c is None:
+            continue
+        i = len(columns["clue_ids"])
+        columns["clue_ids"].append(clue["_id"])
+        columns["clue_values"].append(clue.get("value") or 0)
+        columns["clue_invalid_counts"].append(clue.get("invalid_count") or 0)
+        columns["clue_versions"].append(clue.get("version", 0))
+        updated_on = clue.get("updated_on")
+        columns["clue_updated_on"].append((updated_on - EPOCH).total_seconds() if updated_on else 0)
+        columns["clue_categories"].append(c)
+        columns["clue_canon"].append(bool(clue.get("canon")))
+        clue_text += (clue.get("answer") or "").encode()
+        columns["answer_offsets"].append(len(clue_text))
+        questions += (clue.get("question") or "").encode()
+        question_offsets.append(len(questions))
+        if not clue.get("invalid_count"):
+            valid_positions.append(i)
+        if clue.get("canon"):
+            canon_positions.append(i)
+    # Questions go after the answers in the same blob.
+    columns["question_offsets"] = array("Q", (len(clue_text) + offset for offset in question_offsets))
+    clue_text += questions
+
+    sections = dict(columns, clue_text=clue_text, category_ids=category_ids, category_canon=category_canon,
+                    category_versions=category_versions, title_offsets=title_offsets, category_text=category_text,
+                    valid_positions=valid_positions, canon_positions=canon_positions)
+    directory = os.path.dirname(filename) or "."
+    os.makedirs(directory, exist_ok=True)
+    temporary = f"{filename}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+        locations = []
+        for name, typecode in SECTIONS:
+            # Keep every column 8-byte aligned for the typed views.
+            f.write(b"\0" * (-f.tell() % 8))
+            data = bytes(sections[name])
+            locations += [f.tell(), len(data)]
+            f.write(data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, built_generation, started, *locations))
+        f.flush()
+        os.fsync(f.fileno())
+    # Atomic on POSIX: a worker opening the path gets the old file or the
+    # new one, never a partial write.
+    os.replace(temporary, filename)
+    # Flags from before the scan are in the file now.
+    db.catalog.delete_many({"at": {"$lt": started - SLACK_SECONDS}})
+    stats["builds"] += 1
+    return len(columns["clue_ids"])
+
+
+def load():
+    # Maps the file if it is not the one already mapped.
+    global _current
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    current = _current
+    if current is not None and (current.stat.st_ino, current.stat.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+        return False
+    catalog = Catalog(path)
+    with _lock:
+        _current = catalog
+        for clue_id, flagged_at in list(_forgotten.items()):
+            i = catalog.position(clue_id) if isinstance(clue_id, int) else None
+            if flagged_at < catalog.built_at - SLACK_SECONDS or i is None or catalog.clue_invalid_counts[i]:
+                del _forgotten[clue_id]
+        stats["loads"] += 1
+    return True
+
+
+def poll(db):
+    # Forgets the clues other workers flagged since the last poll.
+    global _polled
+    current = _current
+    if current is None:
+        return
+    since = max(_polled, current.built_at) - SLACK_SECONDS
+    _polled = time.time()
+    for change in db.catalog.find({"at": {"$gte": since}}):
+        with _lock:
+            for clue_id in change["clues"]:
+                _forgotten[clue_id] = max(_forgotten.get(clue_id, 0), change["at"])
+
+
+def refresh(db):
+    load()
+    poll(db)
+    current = _current
+    if current is not None:
+        behind = generation(db) > current.generation or len(_forgotten) >= rebuild_flags
+        if not behind or time.time() - current.built_at < min_rebuild_seconds:
+            return
+    with open(f"{path}.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is building it.
+            return
+        try:
+            # It may have finished a build while we were checking.
+            if load() and generation(db) <= _current.generation and len(_forgotten) < rebuild_flags:
+                return
+            build(db)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    load()
+
+
+def start(get_db):
+    global _thread
+    if not enabled:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def run():
+        while not _stop.is_set():
+            try:
+                refresh(get_db())
+            except Exception:
+                # Keep serving the mapped catalog, or MongoDB without one.
+                pass
+            _stop.wait(check_seconds)
+
+    _stop.clear()
+    _thread = threading.Thread(target=run, name="clue-catalog", daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+
+
+def as_dict():
+    current = _current
+    result = dict(stats)
+    result["enabled"] = enabled
+    result["forgotten"] = len(_forgotten)
+    if current is not None:
+        result["clues"] = len(current)
+        result["generation"] = current.generation
+        result["built_at"] = current.built_at
+        result["bytes"] = current.stat.st_size
+    return result
+
+
+if __name__ == "__main__":
+    from database import close, get_db
+
+    try:
+        started = time.perf_counter()
+        n = build(get_db())
+        print(f"{n} clues written to {path} in {time.perf_counter() - started:.1f}s")
+    finally:
+        close()
+    sys.exit(0)
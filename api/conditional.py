@@ -0,0 +1,92 @@
+# Conditional GET and cache headers for the read endpoints.
+#
+# The write endpoints keep a version counter and an updated_on time on
+# every document they change; documents loaded from jService have neither
+# and count as version 0. Read endpoints build an ETag from versions they
+# have in hand after their main query: the documents' own, the category
+# snapshots clues carry and the counters each worker caches (at most one
+# small read per COUNTERS_CACHE_SECONDS). They call check() before any join, count or further
+# read, so a matching If-None-Match (or If-Modified-Since when there is no
+# ETag to compare) is answered with a bare 304.
+#
+# Every response also gets a Cache-Control from POLICIES so a CDN or
+# reverse proxy can absorb repeat reads. Each policy can be overridden
+# with CACHE_CONTROL_<NAME>, e.g. CACHE_CONTROL_CLUE="no-cache".
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Response
+import hashlib
+import os
+
+POLICIES = {
+    "category": "public, max-age=300",
+    "category_list": "public, max-age=60",
+    "clue": "public, max-age=60",
+    "clue_list": "public, max-age=60",
+    "game": "public, max-age=300",
+    "game_list": "public, max-age=60",
+    # Snapshot games never change; linked ones follow their clues.
+    "custom_game": "public, max-age=300",
+}
+POLICIES = {name: os.environ.get(f'CACHE_CONTROL_{name.upper()}', policy) for name, policy in POLICIES.items()}
+
+
+def version(document):
+    return document.get("version", 0)
+
+
+def etag(kind, *parts):
+    # Strong validator over whatever identifies the response's content.
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=10).hexdigest()
+    return f'"{kind}-{digest}"'
+
+
+def last_modified(*documents):
+    times = [document.get("updated_on") or document.get("created_on") for document in documents]
+    times = [time for time in times if time is not None]
+    return max(times) if times else None
+
+
+def matches(if_none_match, tag):
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+
+def modified_since(if_modified_since, modified):
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return True
+    if since is None:
+        return True
+    if since.tzinfo is None:
+        # -0000 parses to a naive datetime; it still means UTC.
+        since = since.replace(tzinfo=timezone.utc)
+    # HTTP dates have whole seconds; stored times are UTC without tzinfo.
+    return modified.replace(microsecond=0, tzinfo=timezone.utc) > since
+
+
+def check(request, response, policy, tag, modified=None):
+    # Sets the validators and Cache-Control on response and returns a 304
+    # to send instead when the client's copy is current, otherwise None.
+    headers = {"ETag": tag, "Cache-Control": POLICIES[policy]}
+    if modified is not None:
+        headers["Last-Modified"] = format_datetime(modified.replace(tzinfo=timezone.utc), usegmt=True)
+    response.headers.update(headers)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        current = matches(if_none_match, tag)
+    elif modified is not None and request.headers.get("if-modified-since"):
+        current = not modified_since(request.headers["if-modified-since"], modified)
+    else:
+        current = False
+    if current:
+        return Response(status_code=304, headers=headers)
+    return None
@@ -0,0 +1,205 @@
+# Maintained document counters, so list pages never pay for a
+# collection-wide count.
+#
+# Totals live in the "counters" collection as {_id: name, n: count}; the
+# number of clues per category lives on each category as num_clues, and
+# per-game clue count, summed value and valid count in game_stats. The
+# write endpoints adjust them with incr() and incr_games(), and
+# reconcile() recomputes all of them from the data, on a timer and from
+# the command line. Every worker runs the timer, but only the one holding
+# the reconcile lease (a document in counters) does the work each round:
+#
+#     python -m counters
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+import os
+import sys
+import threading
+import time
+
+reconcile_seconds = float(os.environ.get('COUNTERS_RECONCILE_SECONDS', 3600))
+cache_seconds = float(os.environ.get('COUNTERS_CACHE_SECONDS', 30))
+
+# How to compute each counter from scratch. clues.valid is answered from
+# the (invalid_count, _id) index.
+COMPUTE = {
+    "clues": lambda db: db.clues.estimated_document_count(),
+    "clues.valid": lambda db: db.clues.count_documents({"invalid_count": {"$eq": 0}}),
+    "categories": lambda db: db.categories.estimated_document_count(),
+    "games": lambda db: db.games.estimated_document_count(),
+}
+
+GAME_STATS_EMPTY = {"clue_count": 0, "total_value": 0, "valid_count": 0}
+
+_lock = threading.Lock()
+_values = {}
+_loaded_at = 0.0
+_stop = threading.Event()
+_thread = None
+
+
+def cached(name):
+    # This worker's value for name, while it is fresh.
+    with _lock:
+        if time.monotonic() - _loaded_at < cache_seconds and name in _values:
+            return _values[name]
+    return None
+
+
+def remember(values):
+    global _values, _loaded_at
+    with _lock:
+        _values = values
+        _loaded_at = time.monotonic()
+
+
+def get(db, name):
+    value = cached(name)
+    if value is not None:
+        return value
+    values = {doc["_id"]: doc["n"] for doc in db.counters.find({"_id": {"$in": list(COMPUTE)}})}
+    if name not in values:
+        values[name] = COMPUTE[name](db)
+        db.counters.update_one({"_id": name}, {"$set": {"n": values[name]}}, upsert=True)
+    remember(values)
+    return values[name]
+
+
+def invalidate():
+    global _loaded_at
+    with _lock:
+        _loaded_at = 0.0
+
+
+def incr(db, name, n=1):
+    db.counters.update_one({"_id": name}, {"$inc": {"n": n}}, upsert=True)
+    with _lock:
+        if name in _values:
+            _values[name] += n
+
+
+def incr_games(db, field, deltas):
+    # deltas maps game _id to the change in field. Games without stats yet
+    # are left for reconcile_games.
+    updates = [UpdateOne({"_id": game_id}, {"$inc": {field: n}}) for game_id, n in deltas.items() if n]
+    if updates:
+        db.game_stats.bulk_write(updates, ordered=False)
+
+
+def games_pipeline(game_ids=None):
+    # One $group over clues merged into game_stats, all games or only the
+    # given ones (through the game_id index).
+    pipeline = []
+    if game_ids is not None:
+        pipeline.append({"$match": {"game_id": {"$in": list(game_ids)}}})
+    return pipeline + [
+        {"$group": {
+            "_id": "$game_id",
+            "clue_count": {"$sum": 1},
+            "total_value": {"$sum": "$value"},
+            "valid_count": {"$sum": {"$cond": [{"$eq": ["$invalid_count", 0]}, 1, 0]}},
+        }},
+        {"$set": {"reconciled_at": datetime.utcnow()}},
+        {"$merge": {"into": "game_stats", "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+
+
+def empty_games(game_ids):
+    # Games without clues get zeros, so they are not recomputed on every
+    # read.
+    return [UpdateOne({"_id": game_id}, {"$setOnInsert": GAME_STATS_EMPTY}, upsert=True) for game_id in game_ids]
+
+
+def reconcile_games(db, game_ids=None):
+    db.clues.aggregate(games_pipeline(game_ids))
+    if game_ids is not None:
+        db.game_stats.bulk_write(empty_games(game_ids), ordered=False)
+
+
+def game_stats(db, game_ids):
+    # Stats for the given games, building any that are missing.
+    stats = {doc["_id"]: doc for doc in db.game_stats.find({"_id": {"$in": list(game_ids)}})}
+    missing = [game_id for game_id in game_ids if game_id not in stats]
+    if missing:
+        reconcile_games(db, missing)
+        stats.update((doc["_id"], doc) for doc in db.game_stats.find({"_id": {"$in": missing}}))
+    return stats
+
+
+def reconcile(db):
+    values = {name: compute(db) for name, compute in COMPUTE.items()}
+    db.counters.bulk_write(
+        [UpdateOne({"_id": name}, {"$set": {"n": n, "reconciled_at": datetime.utcnow()}}, upsert=True)
+         for name, n in values.items()],
+        ordered=False,
+    )
+    counts = db.clues.aggregate([{"$group": {"_id": "$category_id", "n": {"$sum": 1}}}])
+    updates = []
+    for count in counts:
+        updates.append(UpdateOne({"_id": count["_id"]}, {"$set": {"num_clues": count["n"]}}))
+        if len(updates) == 1000:
+            db.categories.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        db.categories.bulk_write(updates, ordered=False)
+    reconcile_games(db)
+    remember(values)
+    return values
+
+
+def lease(db, seconds):
+    # True for the one worker that takes the reconcile lease for the next
+    # seconds. While it is held the upsert finds no match and its insert
+    # collides with the lease document.
+    now = datetime.utcnow()
+    try:
+        db.counters.update_one(
+            {"_id": "reconcile.lease", "until": {"$lt": now}},
+            {"$set": {"until": now + timedelta(seconds=seconds)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def start(get_db):
+    global _thread
+
+    def run():
+        # Missing totals are computed on demand by get(), so there is no
+        # need for every worker to reconcile as soon as it starts.
+        while not _stop.wait(reconcile_seconds):
+            try:
+                db = get_db()
+                # A little short of the period, so the next round's first
+                # worker finds it expired.
+                if lease(db, reconcile_seconds * 0.9):
+                    reconcile(db)
+            except Exception:
+                # Counters stay at their incrementally maintained values.
+                pass
+
+    _stop.clear()
+    _thread = threading.Thread(target=run, name="counters-reconcile", daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+
+
+if __name__ == "__main__":
+    from database import close, get_db
+
+    try:
+        for name, n in reconcile(get_db()).items():
+            print(f"{name:12} {n}")
+    finally:
+        close()
+    sys.exit(0)
@@ -0,0 +1,183 @@
+from metrics import command_metrics
+from pymongo import monitoring
+import os
+import threading
+import pymongo
+
+dbhost = os.environ['MONGOHOST']
+dbname = os.environ['MONGODATABASE']
+dbuser = os.environ['MONGOUSER']
+dbpass = os.environ['MONGOPASSWORD']
+mongo_str = f"mongodb://{dbuser}:{dbpass}@{dbhost}"
+
+# Pool sizing, see
+# https://pymongo.readthedocs.io/en/stable/faq.html#how-does-connection-pooling-work-in-pymongo
+max_pool_size = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+min_pool_size = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+max_idle_time_ms = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 60000))
+wait_queue_timeout_ms = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 10000))
+
+# "sync" serves every route with pymongo on the threadpool, "async" serves
+# the read routes in routers/aio.py with Motor on the event loop.
+driver = os.environ.get('MONGO_DRIVER', 'sync')
+
+# "mongo" serves every route from MongoDB, "postgres" serves the routes in
+# routers/pg.py from the jService Postgres database. Postgres connection
+# settings come from the PG* environment variables.
+backend = os.environ.get('STORAGE_BACKEND', 'mongo')
+pg_min_pool_size = int(os.environ.get('PG_MIN_POOL_SIZE', 1))
+pg_max_pool_size = int(os.environ.get('PG_MAX_POOL_SIZE', 20))
+pg_pool_timeout = float(os.environ.get('PG_POOL_TIMEOUT', 10))
+
+
+# Running totals of connection pool events, served at /api/_stats
+class PoolStats(monitoring.ConnectionPoolListener):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.checkout_failed = 0
+        self.pools_cleared = 0
+
+    def _bump(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._bump('pools_cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._bump('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._bump('closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._bump('checkout_failed')
+
+    def connection_checked_out(self, event):
+        self._bump('checked_out')
+
+    def connection_checked_in(self, event):
+        self._bump('checked_in')
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "max_pool_size": max_pool_size,
+                "min_pool_size": min_pool_size,
+                "open": self.created - self.closed,
+                "in_use": self.checked_out - self.checked_in,
+                "created": self.created,
+                "closed": self.closed,
+                "checkout_failed": self.checkout_failed,
+                "pools_cleared": self.pools_cleared,
+            }
+
+
+pool_stats = PoolStats()
+client = None
+async_client = None
+pg_pool = None
+
+
+def connect():
+    # One client per process. MongoClient is thread safe and keeps its
+    # own pool, so every request borrows a socket from here instead of
+    # paying for connect + auth + server discovery.
+    global client
+    if client is None:
+        client = pymongo.MongoClient(
+            mongo_str,
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            maxIdleTimeMS=max_idle_time_ms,
+            waitQueueTimeoutMS=wait_queue_timeout_ms,
+            event_listeners=[pool_stats, command_metrics],
+        )
+    return client
+
+
+def connect_async():
+    # Motor wraps its own pymongo client, so it gets its own pool with the
+    # same settings. It binds to the running event loop on first use.
+    global async_client
+    if async_client is None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        async_client = AsyncIOMotorClient(
+            mongo_str,
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            maxIdleTimeMS=max_idle_time_ms,
+            waitQueueTimeoutMS=wait_queue_timeout_ms,
+            event_listeners=[pool_stats, command_metrics],
+        )
+    return async_client
+
+
+def connect_pg(conninfo=""):
+    # prepare_threshold=0 prepares every statement the first time a
+    # connection runs it, so later requests skip parsing and planning.
+    global pg_pool
+    if pg_pool is None:
+        from psycopg.rows import dict_row
+        from psycopg_pool import ConnectionPool
+
+        pg_pool = ConnectionPool(
+            conninfo,
+            min_size=pg_min_pool_size,
+            max_size=pg_max_pool_size,
+            timeout=pg_pool_timeout,
+            kwargs={"prepare_threshold": 0, "row_factory": dict_row},
+        )
+    return pg_pool
+
+
+def close():
+    global client, async_client, pg_pool
+    if client is not None:
+        client.close()
+        client = None
+    if async_client is not None:
+        async_client.close()
+        async_client = None
+    if pg_pool is not None:
+        pg_pool.close()
+        pg_pool = None
+
+
+def get_client():
+    return connect()
+
+
+def get_db():
+    return connect()[dbname]
+
+
+def get_async_db():
+    return connect_async()[dbname]
+
+
+def get_pg():
+    # A pooled connection for the request; committed when it is returned.
+    with connect_pg().connection() as conn:
+        yield conn
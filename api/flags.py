@@ -0,0 +1,179 @@
+# Write-behind batching of clue flags, opt in with FLAG_WRITE_BEHIND=1.
+#
+# PUT /api/clues/{id} records the flag here instead of writing it. Flags
+# for the same clue are summed in memory and written with one unordered
+# bulk_write every FLAG_FLUSH_SECONDS, sooner once FLAG_FLUSH_MAX clues are
+# pending, and once more on shutdown. A clue is read the first time it is
+# flagged in a window; repeat flags cost no commands at all. A clue's
+# first flag is written only if the clue is still valid on the server, so
+# clues.valid and game_stats drop once however many workers flag it.
+#
+# Until its flags are written a clue is hidden from this worker's reads
+# through hidden(). Other workers keep serving it until the flush lands,
+# and flags pending in a worker that dies are lost.
+from bson.objectid import ObjectId
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import catalog
+import counters
+import os
+import threading
+
+enabled = os.environ.get('FLAG_WRITE_BEHIND', '0') == '1'
+flush_seconds = float(os.environ.get('FLAG_FLUSH_SECONDS', 1))
+flush_max = int(os.environ.get('FLAG_FLUSH_MAX', 1000))
+
+_lock = threading.Lock()
+# clue _id -> [clue as it was before these flags, number of flags]
+_pending = {}
+# The batch a flush is writing; still hidden until it is done.
+_flushing = {}
+_wake = threading.Event()
+_stop = threading.Event()
+_thread = None
+_get_db = None
+stats = {"flags": 0, "reads": 0, "flushes": 0, "writes": 0, "failures": 0}
+
+
+def hidden(clue_id):
+    return clue_id in _pending or clue_id in _flushing
+
+
+def add(db, clue_id):
+    # Returns the clue as it will be once its flags are written, or None
+    # when there is no such clue.
+    with _lock:
+        entry = _pending.get(clue_id)
+        if entry is None and clue_id in _flushing:
+            # Start from the batch being written instead of reading a
+            # document that may or may not include it yet.
+            clue, n = _flushing[clue_id]
+            entry = _pending[clue_id] = [dict(clue, invalid_count=clue["invalid_count"] + n), 0]
+        if entry is not None:
+            return _record(entry)
+    clue = db.clues.find_one({"_id": clue_id})
+    if clue is None:
+        return None
+    with _lock:
+        stats["reads"] += 1
+        entry = _pending.setdefault(clue_id, [clue, 0])
+        return _record(entry)
+
+
+def _record(entry):
+    # Called with _lock held.
+    entry[1] += 1
+    stats["flags"] += 1
+    if len(_pending) >= flush_max:
+        _wake.set()
+    return dict(entry[0], invalid_count=entry[0]["invalid_count"] + entry[1])
+
+
+def _requeue(batch):
+    # Called with _lock held. Flags added since the batch was taken were
+    # counted on top of it, so they keep the batch's starting document.
+    for clue_id, (clue, n) in batch.items():
+        entry = _pending.get(clue_id)
+        _pending[clue_id] = [clue, n + (entry[1] if entry is not None else 0)]
+
+
+def flush(db):
+    global _flushing
+    with _lock:
+        if not _pending:
+            return 0
+        batch = dict(_pending)
+        _pending.clear()
+        _flushing = batch
+    now = datetime.utcnow()
+    token = ObjectId()
+    ids = list(batch)
+    # Clues that were valid when first flagged. Their update only matches
+    # while the clue is still valid and tags it with this flush's token, so
+    # when two workers flag the same clue only one counts the transition.
+    candidates = [clue_id for clue_id in ids if batch[clue_id][0]["invalid_count"] == 0]
+    # Off the catalog before the writes land, not after.
+    catalog.forget(ids)
+    failed = {}
+    try:
+        db.clues.bulk_write([flag_update(clue_id, batch[clue_id], now, token) for clue_id in ids], ordered=False)
+    except BulkWriteError as e:
+        failed = {ids[error["index"]]: batch[ids[error["index"]]] for error in e.details["writeErrors"]}
+    except Exception:
+        failed = batch
+    candidates = [clue_id for clue_id in candidates if clue_id not in failed]
+    newly = []
+    if candidates:
+        newly = list(db.clues.find({"_id": {"$in": candidates}, "flag_batch": token}, {"game_id": 1}))
+    # Another worker made these invalid first; their flags still count.
+    lost = set(candidates) - {clue["_id"] for clue in newly}
+    if lost:
+        try:
+            db.clues.bulk_write([flag_update(clue_id, batch[clue_id], now) for clue_id in lost], ordered=False)
+        except Exception:
+            failed.update({clue_id: batch[clue_id] for clue_id in lost})
+    games = {}
+    for clue in newly:
+        games[clue.get("game_id")] = games.get(clue.get("game_id"), 0) - 1
+    with _lock:
+        _requeue(failed)
+        _flushing = {}
+        stats["flushes"] += 1
+        stats["writes"] += len(batch) - len(failed)
+        stats["failures"] += len(failed)
+    if newly:
+        counters.incr(db, "clues.valid", -len(newly))
+        counters.incr_games(db, "valid_count", games)
+        catalog.publish(db, [clue["_id"] for clue in newly])
+    return len(batch) - len(failed)
+
+
+def flag_update(clue_id, entry, now, token=None):
+    # With a token, only a clue that is still valid is updated.
+    clue, n = entry
+    update = {"$inc": {"invalid_count": n, "version": 1}, "$set": {"updated_on": now}}
+    if token is None or clue["invalid_count"] != 0:
+        return UpdateOne({"_id": clue_id}, update)
+    update["$set"]["flag_batch"] = token
+    return UpdateOne({"_id": clue_id, "invalid_count": 0}, update)
+
+
+def start(get_db):
+    global _thread, _get_db
+    if not enabled:
+        return
+    _get_db = get_db
+
+    def run():
+        while not _stop.is_set():
+            _wake.wait(flush_seconds)
+            _wake.clear()
+            try:
+                flush(get_db())
+            except Exception:
+                # Failed flags were requeued, the next round retries them.
+                pass
+
+    _stop.clear()
+    _thread = threading.Thread(target=run, name="flag-flush", daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+    if _get_db is not None:
+        flush(_get_db())
+
+
+def as_dict():
+    with _lock:
+        result = dict(stats)
+        result["pending"] = len(_pending)
+    result["enabled"] = enabled
+    return result
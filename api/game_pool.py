@@ -0,0 +1,105 @@
+# Pool of ready-made custom games.
+#
+# A background producer keeps up to GAME_POOL_SIZE game definitions
+# waiting in game_definitions with pooled: true, refilling once fewer than
+# GAME_POOL_LOW are left. POST /api/custom-games claims one with a single
+# find_one_and_update and only builds a game inline when the pool is
+# empty. Each worker runs its own producer, so with several workers the
+# pool can hold up to GAME_POOL_SIZE per worker. GAME_POOL_SIZE=0 turns
+# the pool off.
+from datetime import datetime
+from pymongo import ReturnDocument
+import os
+import threading
+
+pool_size = int(os.environ.get('GAME_POOL_SIZE', 50))
+low_water = int(os.environ.get('GAME_POOL_LOW', 20))
+check_seconds = float(os.environ.get('GAME_POOL_CHECK_SECONDS', 5))
+
+_wake = threading.Event()
+_stop = threading.Event()
+_thread = None
+_lock = threading.Lock()
+stats = {"claimed": 0, "fallbacks": 0, "produced": 0}
+
+
+def _bump(name):
+    with _lock:
+        stats[name] += 1
+
+
+def claim(db, keep_snapshot):
+    # Atomically take the oldest pooled game and stamp it as created now.
+    # The pooled copy always carries its clues so it can be returned right
+    # away; they are dropped from the stored document unless snapshots are
+    # on, to match games built inline.
+    if pool_size <= 0:
+        return None
+    now = datetime.utcnow()
+    update = {"$unset": {"pooled": ""}, "$set": {"created_on": now}}
+    if not keep_snapshot:
+        update["$unset"]["clues"] = ""
+    game = db.game_definitions.find_one_and_update(
+        {"pooled": True},
+        update,
+        sort=[("_id", 1)],
+        return_document=ReturnDocument.BEFORE,
+    )
+    if game is None:
+        _bump("fallbacks")
+        _wake.set()
+        return None
+    _bump("claimed")
+    del game["pooled"]
+    game["created_on"] = now
+    # Let the producer check the low-water mark.
+    _wake.set()
+    return game
+
+
+def fill(db, build):
+    waiting = db.game_definitions.count_documents({"pooled": True})
+    if waiting >= low_water:
+        return
+    for _ in range(pool_size - waiting):
+        if _stop.is_set():
+            return
+        build(db, pooled=True)
+        _bump("produced")
+
+
+def start(get_db, build):
+    global _thread
+    if pool_size <= 0:
+        return
+
+    def run():
+        while not _stop.is_set():
+            try:
+                fill(get_db(), build)
+            except Exception:
+                # Claims fall back to building games inline meanwhile.
+                pass
+            _wake.wait(check_seconds)
+            _wake.clear()
+
+    _stop.clear()
+    _thread = threading.Thread(target=run, name="game-pool", daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+
+
+def as_dict():
+    with _lock:
+        result = dict(stats)
+    result["size"] = pool_size
+    result["low_water"] = low_water
+    return result
@@ -0,0 +1,197 @@
+# Index bootstrap for every query shape the routers issue.
+#
+# ensure_indexes() runs at startup, and ensure_pg_indexes() too when the
+# routes in routers/pg.py are served from Postgres. Running the module
+# directly creates
+# the indexes and, with --explain, prints the winning plan of each
+# endpoint's query and exits non-zero if any of them is a COLLSCAN:
+#
+#     python -m indexes --explain
+from pymongo import ASCENDING, TEXT, IndexModel
+import sys
+
+INDEXES = {
+    "clues": [
+        # clues_list (page and keyset), get_random_clue(valid=True)
+        IndexModel([("invalid_count", ASCENDING), ("_id", ASCENDING)], name="invalid_count_id"),
+        # categories_list clue counts
+        IndexModel([("category_id", ASCENDING)], name="category_id"),
+        # create_custom_game canon sampling
+        IndexModel([("canon", ASCENDING)], name="canon"),
+        # counters.reconcile_games for single games
+        IndexModel([("game_id", ASCENDING)], name="game_id"),
+        # search_clues, over the category title embedded by snapshots.py
+        # too; a collection can only have one text index
+        IndexModel(
+            [("question", TEXT), ("answer", TEXT), ("category.title", TEXT)],
+            name="text_category",
+            weights={"answer": 2, "question": 1, "category.title": 1},
+            default_language="english",
+        ),
+    ],
+    "categories": [
+        # categories_list sorted pages and keyset cursor
+        IndexModel([("title", ASCENDING), ("_id", ASCENDING)], name="title_id"),
+    ],
+    "game_definitions": [
+        # game_pool claims and refill checks; only pooled games are indexed
+        IndexModel([("pooled", ASCENDING), ("_id", ASCENDING)], name="pooled",
+                   partialFilterExpression={"pooled": True}),
+    ],
+    "game_definition_clues": [
+        # get_custom_game
+        IndexModel([("game_definition_id", ASCENDING)], name="game_definition_id"),
+    ],
+    "catalog": [
+        # catalog.poll and the cleanup after a rebuild
+        IndexModel([("at", ASCENDING)], name="at"),
+    ],
+}
+
+
+# The Postgres counterparts, for the jService tables read by routers/pg.py.
+PG_INDEXES = [
+    # clues_list and random clue, over valid clues only
+    "CREATE INDEX IF NOT EXISTS clues_valid_id ON clues (id) WHERE invalid_count = 0",
+    # categories_list clue counts
+    "CREATE INDEX IF NOT EXISTS clues_category_id ON clues (category_id)",
+    # game totals
+    "CREATE INDEX IF NOT EXISTS clues_game_id ON clues (game_id)",
+    # categories_list sorted pages and keyset cursor
+    "CREATE INDEX IF NOT EXISTS categories_title_id ON categories (title, id)",
+]
+
+
+def ensure_pg_indexes(conn):
+    for statement in PG_INDEXES:
+        conn.execute(statement)
+    conn.commit()
+
+
+def ensure_indexes(db):
+    # create_indexes is a no-op for indexes that already exist with the
+    # same keys and options, so this is safe on every startup.
+    for collection, models in INDEXES.items():
+        db[collection].create_indexes(models)
+
+
+def query_shapes(db):
+    # One representative query per endpoint, as (name, command).
+    clue = db.clues.find_one() or {}
+    category = db.categories.find_one() or {}
+    link = db.game_definition_clues.find_one() or {}
+    return [
+        ("clues_list", {
+            "find": "clues",
+            "filter": {"invalid_count": {"$eq": 0}},
+            "sort": {"_id": 1},
+            "limit": 100,
+        }),
+        ("clues_list?after", {
+            "find": "clues",
+            "filter": {"invalid_count": {"$eq": 0}, "_id": {"$gt": clue.get("_id")}},
+            "sort": {"_id": 1},
+            "limit": 100,
+        }),
+        ("categories_list", {
+            "find": "categories",
+            "sort": {"title": 1, "_id": 1},
+            "limit": 100,
+        }),
+        ("categories_list num_clues", {
+            "aggregate": "clues",
+            "pipeline": [
+                {"$match": {"category_id": {"$in": [category.get("_id")]}}},
+                {"$group": {"_id": "$category_id", "n": {"$sum": 1}}},
+            ],
+            "cursor": {},
+        }),
+        ("get_random_clue", {
+            "aggregate": "clues",
+            "pipeline": [{"$match": {"invalid_count": {"$eq": 0}}}, {"$sample": {"size": 1}}],
+            "cursor": {},
+        }),
+        ("create_custom_game", {
+            "aggregate": "clues",
+            "pipeline": [{"$match": {"canon": {"$eq": True}}}, {"$sample": {"size": 30}}],
+            "cursor": {},
+        }),
+        ("games_list", {
+            "find": "games",
+            "sort": {"_id": 1},
+            "limit": 100,
+        }),
+        ("get_game stats", {
+            "find": "game_stats",
+            "filter": {"_id": {"$in": [clue.get("game_id")]}},
+        }),
+        ("reconcile_games one game", {
+            "aggregate": "clues",
+            "pipeline": [
+                {"$match": {"game_id": {"$in": [clue.get("game_id")]}}},
+                {"$group": {"_id": "$game_id", "n": {"$sum": 1}, "value": {"$sum": "$value"}}},
+            ],
+            "cursor": {},
+        }),
+        ("search_clues", {
+            "aggregate": "clues",
+            "pipeline": [
+                {"$match": {"$text": {"$search": "river"}, "invalid_count": {"$eq": 0}}},
+                {"$addFields": {"score": {"$meta": "textScore"}}},
+                {"$sort": {"score": -1, "_id": 1}},
+                {"$limit": 25},
+            ],
+            "cursor": {},
+        }),
+        ("get_custom_game", {
+            "find": "game_definition_clues",
+            "filter": {"game_definition_id": link.get("game_definition_id")},
+        }),
+    ]
+
+
+def plan_stages(plan):
+    # Every stage name in an explain plan tree.
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+def explain_report(db):
+    report = []
+    for name, command in query_shapes(db):
+        explained = db.command({"explain": command, "verbosity": "queryPlanner"})
+        stages = []
+        for stage in plan_stages(explained):
+            if stage not in stages:
+                stages.append(stage)
+        report.append((name, stages, "COLLSCAN" in stages))
+    return report
+
+
+def main(argv):
+    from database import close, get_db
+
+    db = get_db()
+    try:
+        ensure_indexes(db)
+        print("indexes ensured")
+        if "--explain" not in argv:
+            return 0
+        failed = False
+        for name, stages, collscan in explain_report(db):
+            flag = "COLLSCAN" if collscan else "ok"
+            print(f"{flag:8} {name:28} {' > '.join(stages)}")
+            failed = failed or collscan
+        return 1 if failed else 0
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,154 @@
+# Bulk loader from the jService Postgres database into MongoDB.
+#
+# The db service loads jservice.sql into Postgres; this copies it into the
+# categories, games and clues collections in the shapes the routers read.
+# Rows are streamed through server-side cursors in id order and written
+# with unordered insert_many batches on a pool of threads.
+#
+# Progress is checkpointed per table in the loader_checkpoints collection
+# as the highest id below which every batch has been written, so an
+# interrupted load picks up where it stopped. Rows already written by a
+# batch that was in flight are skipped as duplicate keys.
+#
+#     python -m loader                      # everything, resuming
+#     python -m loader --tables clues --workers 8
+#     python -m loader --restart            # ignore checkpoints
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import BulkWriteError
+import argparse
+import psycopg
+import sys
+import time
+
+DUPLICATE_KEY = 11000
+
+TABLES = {
+    "categories": {
+        "sql": "SELECT id, title, canon FROM categories WHERE id > %s ORDER BY id",
+        "document": lambda row: {"_id": row[0], "title": row[1], "canon": bool(row[2])},
+    },
+    "games": {
+        "sql": "SELECT id, episode_id, aired, canon FROM games WHERE id > %s ORDER BY id",
+        "document": lambda row: {
+            "_id": row[0],
+            "episode_id": row[1],
+            "aired": str(row[2]) if row[2] is not None else "",
+            "canon": bool(row[3]),
+        },
+    },
+    "clues": {
+        "sql": """
+            SELECT clues.id, answer, question, value, invalid_count, clues.canon, category_id, game_id,
+                categories.title, categories.canon
+            FROM clues LEFT JOIN categories ON categories.id = clues.category_id
+            WHERE clues.id > %s ORDER BY clues.id
+        """,
+        "document": lambda row: {
+            "_id": row[0],
+            "answer": row[1],
+            "question": row[2],
+            "value": row[3] or 0,
+            "invalid_count": row[4] or 0,
+            "canon": bool(row[5]),
+            "category_id": row[6],
+            "game_id": row[7],
+            # Embedded category snapshot, see snapshots.py.
+            **({"category": {"id": str(row[6]), "title": row[8], "canon": bool(row[9]), "version": 0}}
+               if row[8] is not None else {}),
+        },
+    },
+}
+
+
+def insert(collection, documents):
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        # Rows written before an interrupted run are expected on resume.
+        errors = [error for error in e.details["writeErrors"] if error["code"] != DUPLICATE_KEY]
+        if errors:
+            raise
+
+
+def estimated_rows(conn, table):
+    with conn.cursor() as cur:
+        cur.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+        row = cur.fetchone()
+        return max(row[0], 0) if row else 0
+
+
+def load_table(conn, db, pool, table, batch_size, workers, restart):
+    spec = TABLES[table]
+    checkpoint = db.loader_checkpoints.find_one({"_id": table}) or {}
+    last_id = 0 if restart else checkpoint.get("last_id", 0)
+    total = estimated_rows(conn, table)
+    print(f"{table}: starting after id {last_id}, about {total} rows")
+
+    in_flight = deque()
+    written = 0
+    started = reported = time.monotonic()
+
+    def settle(block):
+        # Advance the checkpoint over the leading batches that are done.
+        nonlocal written
+        while in_flight and (block or in_flight[0][0].done()):
+            future, batch_last_id, size = in_flight.popleft()
+            future.result()
+            written += size
+            db.loader_checkpoints.update_one({"_id": table}, {"$set": {"last_id": batch_last_id}}, upsert=True)
+            block = False
+
+    # A named cursor is a server-side cursor: Postgres hands rows over in
+    # chunks of itersize instead of materializing the table client side.
+    with conn.cursor(name=f"load_{table}") as cur:
+        cur.itersize = batch_size
+        cur.execute(spec["sql"], [last_id])
+        batch = []
+        for row in cur:
+            batch.append(spec["document"](row))
+            if len(batch) == batch_size:
+                in_flight.append((pool.submit(insert, db[table], batch), batch[-1]["_id"], len(batch)))
+                batch = []
+                settle(len(in_flight) >= workers * 2)
+                if time.monotonic() - reported > 5:
+                    reported = time.monotonic()
+                    rate = written / (reported - started)
+                    print(f"{table}: {written}/{total} rows, {rate:.0f} rows/s")
+        if batch:
+            in_flight.append((pool.submit(insert, db[table], batch), batch[-1]["_id"], len(batch)))
+        while in_flight:
+            settle(True)
+    elapsed = time.monotonic() - started
+    print(f"{table}: {written} rows in {elapsed:.1f}s")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m loader")
+    parser.add_argument("--tables", nargs="+", choices=list(TABLES), default=list(TABLES))
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=4, help="parallel insert_many batches")
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoints and start from the first row")
+    args = parser.parse_args(argv)
+
+    from database import close, get_db
+    from indexes import ensure_indexes
+    import counters
+
+    db = get_db()
+    try:
+        # Connection settings come from the PG* environment variables.
+        with psycopg.connect() as conn, ThreadPoolExecutor(args.workers) as pool:
+            for table in args.tables:
+                load_table(conn, db, pool, table, args.batch_size, args.workers, args.restart)
+        # Ensured after the data is in, so a fresh database builds each
+        # index once instead of maintaining it on every insert.
+        ensure_indexes(db)
+        counters.reconcile(db)
+    finally:
+        close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
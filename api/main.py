@@ -1,11 +1,122 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
 
-from routers import categories, clues, games
+from routers import aio, categories, clues, games, pg
+from routers.categories import category_cache
+from indexes import ensure_indexes, ensure_pg_indexes
+from sampling import valid_clues
+import catalog
+import counters
+import database
+import flags
+import game_pool
+import metrics
+import profiling
+import snapshots
 
 app = FastAPI()
 
+
+def include_overrides(router):
+    # The router's routes replace the ones already registered with the same
+    # path and methods, in their place, so a static path declared ahead of
+    # a parameterized one (/api/clues/search before /api/clues/{clue_id})
+    # still wins.
+    start = len(app.router.routes)
+    app.include_router(router)
+    added = app.router.routes[start:]
+    del app.router.routes[start:]
+    for route in added:
+        for i, existing in enumerate(app.router.routes):
+            if getattr(existing, "path", None) == route.path and getattr(existing, "methods", None) == route.methods:
+                app.router.routes[i] = route
+                break
+        else:
+            app.router.routes.append(route)
+
+
 # Using routers for organization
 # See https://fastapi.tiangolo.com/tutorial/bigger-applications/
 app.include_router(categories.router)
 app.include_router(clues.router)
 app.include_router(games.router)
+if database.driver == "async":
+    include_overrides(aio.router)
+if database.backend == "postgres":
+    include_overrides(pg.router)
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    holder = metrics.start_request(request.scope)
+    try:
+        response = await call_next(request)
+    except Exception:
+        metrics.finish_request(holder, request.method, 500)
+        raise
+    metrics.finish_request(holder, request.method, response.status_code)
+    return response
+
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    if not profiling.wanted(request.headers):
+        return await call_next(request)
+    sampler = profiling.Sampler(request.scope)
+    sampler.start()
+    try:
+        response = await call_next(request)
+    finally:
+        sampler.stop()
+    name = await run_in_threadpool(profiling.write, metrics.route_label(request.scope), sampler)
+    if name is not None:
+        response.headers["X-Profile-File"] = name
+    return response
+
+
+@app.on_event("startup")
+def startup():
+    database.connect()
+    ensure_indexes(database.get_db())
+    if database.backend == "postgres":
+        with database.connect_pg().connection() as conn:
+            ensure_pg_indexes(conn)
+    valid_clues.start(database.get_db)
+    counters.start(database.get_db)
+    game_pool.start(database.get_db, games.build_custom_game)
+    flags.start(database.get_db)
+    snapshots.start(database.get_db)
+    catalog.start(database.get_db)
+
+
+@app.on_event("shutdown")
+def shutdown():
+    valid_clues.stop()
+    counters.stop()
+    game_pool.stop()
+    # Writes the flags still pending, before the client goes away.
+    flags.stop()
+    snapshots.stop()
+    catalog.stop()
+    database.close()
+
+
+@app.get("/api/_stats")
+def stats():
+    return {
+        "pool": database.pool_stats.as_dict(),
+        "postgres_pool": database.pg_pool.get_stats() if database.pg_pool is not None else None,
+        "random_clue_pool": valid_clues.as_dict(),
+        "category_cache": category_cache.as_dict(),
+        "game_pool": game_pool.as_dict(),
+        "flags": flags.as_dict(),
+        "category_snapshots": snapshots.as_dict(),
+        "clue_catalog": catalog.as_dict(),
+        "slow_commands": metrics.slowest(),
+    }
+
+
+@app.get("/api/_metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,197 @@
+# Request and MongoDB instrumentation, served at /api/_metrics in the
+# Prometheus text format.
+#
+# The http middleware in main.py puts a per-request holder in a ContextVar.
+# Sync handlers run on the threadpool with a copy of that context, so the
+# CommandListener below, which runs on the thread issuing each command,
+# can charge the command to the route that caused it. Commands issued
+# outside a request (background refreshes, Motor's executor threads) are
+# reported under route="other".
+from contextvars import ContextVar
+from pymongo import monitoring
+import heapq
+import os
+import threading
+import time
+
+slow_commands_kept = int(os.environ.get('METRICS_SLOW_COMMANDS', 20))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 25, 50, 100)
+
+current_request = ContextVar("current_request", default=None)
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            label_str = format_labels(labels)
+            prefix = label_str[1:-1] + "," if label_str else ""
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {count}")
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+
+    def inc(self, labels, value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+_lock = threading.Lock()
+requests_total = Counter("http_requests_total", "HTTP requests by route, method and status.")
+request_duration = Histogram("http_request_duration_seconds", "Total request latency.", LATENCY_BUCKETS)
+request_commands = Histogram("http_request_mongodb_commands", "MongoDB commands issued per request.", COUNT_BUCKETS)
+commands_total = Counter("mongodb_commands_total", "MongoDB commands by route and command.")
+command_failures = Counter("mongodb_command_failures_total", "Failed MongoDB commands by route and command.")
+command_duration = Histogram("mongodb_command_duration_seconds", "MongoDB command latency.", LATENCY_BUCKETS)
+request_db_duration = Histogram("http_request_mongodb_seconds", "Time spent in MongoDB per request.", LATENCY_BUCKETS)
+slow_commands = []
+_route_paths = {}
+
+
+def route_label(scope):
+    # The matched route's path template, e.g. /api/clues/{clue_id}.
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    path = _route_paths.get(endpoint)
+    if path is None:
+        path = "unmatched"
+        for route in scope["app"].routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                path = route.path
+                break
+        _route_paths[endpoint] = path
+    return path
+
+
+def start_request(scope):
+    holder = {"scope": scope, "commands": 0, "db_seconds": 0.0, "started": time.perf_counter()}
+    current_request.set(holder)
+    return holder
+
+
+def finish_request(holder, method, status):
+    elapsed = time.perf_counter() - holder["started"]
+    route = route_label(holder["scope"])
+    with _lock:
+        requests_total.inc((("route", route), ("method", method), ("status", status)))
+        request_duration.observe((("route", route),), elapsed)
+        request_commands.observe((("route", route),), holder["commands"])
+        request_db_duration.observe((("route", route),), holder["db_seconds"])
+
+
+def summarize(command):
+    # Filter or pipeline of a command, truncated, for the slow command list.
+    for key in ("filter", "query", "pipeline", "updates", "q"):
+        if key in command:
+            return repr(command[key])[:200]
+    return ""
+
+
+class CommandMetrics(monitoring.CommandListener):
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        holder = current_request.get()
+        collection = event.command.get(event.command_name)
+        self._pending[(event.connection_id, event.request_id)] = (
+            holder,
+            collection if isinstance(collection, str) else "",
+            summarize(event.command),
+        )
+
+    def _finish(self, event, failed):
+        holder, collection, summary = self._pending.pop((event.connection_id, event.request_id), (None, "", ""))
+        seconds = event.duration_micros / 1e6
+        route = route_label(holder["scope"]) if holder else "other"
+        if holder:
+            holder["commands"] += 1
+            holder["db_seconds"] += seconds
+        with _lock:
+            commands_total.inc((("route", route), ("command", event.command_name)))
+            if failed:
+                command_failures.inc((("route", route), ("command", event.command_name)))
+            command_duration.observe((("command", event.command_name),), seconds)
+            entry = (seconds, route, event.command_name, collection, summary)
+            if len(slow_commands) < slow_commands_kept:
+                heapq.heappush(slow_commands, entry)
+            elif seconds > slow_commands[0][0]:
+                heapq.heapreplace(slow_commands, entry)
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+
+command_metrics = CommandMetrics()
+
+
+def slowest():
+    with _lock:
+        entries = sorted(slow_commands, reverse=True)
+    return [
+        {"seconds": seconds, "route": route, "command": command, "collection": collection, "query": summary}
+        for seconds, route, command, collection, summary in entries
+    ]
+
+
+def render():
+    with _lock:
+        lines = []
+        for metric in (requests_total, request_duration, request_commands, request_db_duration,
+                       commands_total, command_failures, command_duration):
+            lines.extend(metric.render())
+        lines.append("# HELP mongodb_slowest_command_seconds Slowest MongoDB commands seen by this process.")
+        lines.append("# TYPE mongodb_slowest_command_seconds gauge")
+        for rank, (seconds, route, command, collection, summary) in enumerate(sorted(slow_commands, reverse=True)):
+            labels = (("rank", rank), ("route", route), ("command", command), ("collection", collection))
+            lines.append(f"mongodb_slowest_command_seconds{format_labels(labels)} {seconds}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,102 @@
+# On-demand profiling of live requests.
+#
+# A request is profiled when it is picked by PROFILE_SAMPLE_RATE, or when
+# it sends "X-Profile: 1" with an X-Profile-Token matching
+# PROFILE_ADMIN_TOKEN. While it runs, a sampling thread snapshots every
+# thread's stack each PROFILE_INTERVAL seconds and keeps the ones that pass
+# through the matched endpoint, which is how it finds the threadpool
+# worker running a sync handler (cProfile only sees its own thread).
+#
+# Each profile is written to PROFILE_DIR as <route>.<time>.folded in the
+# collapsed stack format read by flamegraph.pl and speedscope. The oldest
+# files are removed once PROFILE_MAX_FILES or PROFILE_MAX_BYTES is passed.
+from collections import Counter
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+admin_token = os.environ.get('PROFILE_ADMIN_TOKEN')
+interval = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+profile_dir = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+max_files = int(os.environ.get('PROFILE_MAX_FILES', 200))
+max_bytes = int(os.environ.get('PROFILE_MAX_BYTES', 50 * 1024 * 1024))
+
+_write_lock = threading.Lock()
+
+
+def wanted(headers):
+    if headers.get("x-profile") == "1":
+        # Constant time, so the token cannot be guessed from response times.
+        token = headers.get("x-profile-token")
+        return admin_token is not None and token is not None and hmac.compare_digest(token.encode(), admin_token.encode())
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler(threading.Thread):
+
+    def __init__(self, scope):
+        super().__init__(name="request-profiler", daemon=True)
+        self.scope = scope
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._done.wait(interval):
+            endpoint = self.scope.get("endpoint")
+            if endpoint is None:
+                # Not routed yet.
+                continue
+            target = getattr(endpoint, "__code__", None)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    if frame.f_code is target:
+                        self.stacks[";".join(frame_name(code) for code in reversed(stack))] += 1
+                        break
+                    frame = frame.f_back
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def write(route, sampler):
+    if not sampler.stacks:
+        return None
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    name = f"{slug}.{time.strftime('%Y%m%dT%H%M%S')}.{int(time.time() * 1000) % 1000:03}.folded"
+    with _write_lock:
+        os.makedirs(profile_dir, exist_ok=True)
+        with open(os.path.join(profile_dir, name), "w") as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        prune()
+    return name
+
+
+def prune():
+    # Keep the newest profiles within the file and byte limits.
+    entries = []
+    for name in os.listdir(profile_dir):
+        if name.endswith(".folded"):
+            stat = os.stat(os.path.join(profile_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort(reverse=True)
+    total = 0
+    for i, (mtime, size, name) in enumerate(entries):
+        total += size
+        if i >= max_files or total > max_bytes:
+            os.remove(os.path.join(profile_dir, name))
@@ -0,0 +1,202 @@
+from fastapi import APIRouter, Depends, Query, Request, Response
+from typing import Literal, Optional, Union
+from database import get_async_db
+from routers import categories, clues, games
+from routers.categories import Categories, CategoryOut, Message
+from routers.clues import ClueBatch, ClueBatchIn, ClueOut, Clues, ClueSearch
+from routers.games import CustomGameOut, GameOut, Games
+import bson
+import counters
+
+# Async versions of the read routes, served with Motor when
+# MONGO_DRIVER=async. main.py swaps them in for the sync routes at the same
+# path and method (see include_overrides). Query building and shaping are
+# the sync routers' own functions; these only await the reads in between.
+#
+# The writes and the clue export stay sync on the threadpool: they share
+# counters, flags, catalog and game_pool with the background threads,
+# which use pymongo.
+router = APIRouter()
+
+
+async def load_categories(db, category_ids):
+    found, missing = categories.cached_categories(category_ids)
+    if missing:
+        categories.add_categories(found, await db.categories.find({"_id": {"$in": missing}}).to_list(None))
+    return found
+
+
+async def attach_categories(db, clue_list):
+    return categories.set_categories(clue_list, await load_categories(db, categories.uncategorized(clue_list)))
+
+
+async def count_clues(db, category_ids):
+    if not category_ids:
+        return {}
+    counts = await db.clues.aggregate(categories.count_clues_pipeline(category_ids)).to_list(None)
+    return {count["_id"]: count["n"] for count in counts}
+
+
+async def get_counter(db, name):
+    # counters.get; Motor has the same methods as pymongo for COMPUTE.
+    value = counters.cached(name)
+    if value is not None:
+        return value
+    values = {doc["_id"]: doc["n"] for doc in await db.counters.find({"_id": {"$in": list(counters.COMPUTE)}}).to_list(None)}
+    if name not in values:
+        values[name] = await counters.COMPUTE[name](db)
+        await db.counters.update_one({"_id": name}, {"$set": {"n": values[name]}}, upsert=True)
+    counters.remember(values)
+    return values[name]
+
+
+async def game_stats(db, game_ids):
+    # counters.game_stats. A Motor aggregate only runs once it is read.
+    stats = {doc["_id"]: doc for doc in await db.game_stats.find({"_id": {"$in": list(game_ids)}}).to_list(None)}
+    missing = [game_id for game_id in game_ids if game_id not in stats]
+    if missing:
+        await db.clues.aggregate(counters.games_pipeline(missing)).to_list(None)
+        await db.game_stats.bulk_write(counters.empty_games(missing), ordered=False)
+        stats.update((doc["_id"], doc) for doc in await db.game_stats.find({"_id": {"$in": missing}}).to_list(None))
+    return stats
+
+
+@router.get("/api/categories", response_model=Categories)
+async def categories_list_async(request: Request, response: Response, page: int = 0, after: Optional[str] = None, db=Depends(get_async_db)):
+    query, skip = categories.categories_page_query(page, after)
+    page_categories = await db.categories.find(query).sort(categories.CATEGORY_ORDER).skip(skip).limit(100).to_list(None)
+    page_count = await get_counter(db, "categories") // 100
+    not_modified = categories.check_categories_page(request, response, page_categories, page, after, page_count)
+    if not_modified:
+        return not_modified
+    counts = await count_clues(db, categories.uncounted(page_categories))
+    return categories.categories_page(page_categories, counts, page_count)
+
+
+@router.get(
+    "/api/categories/{category_id}",
+    response_model=CategoryOut,
+    responses={404: {"model": Message}},
+)
+async def get_category_async(category_id: Union[int, str], request: Request, response: Response, db=Depends(get_async_db)):
+    if isinstance(category_id, str):
+        true_id = bson.objectid.ObjectId(category_id)
+    else:
+        true_id = category_id
+    category = (await load_categories(db, [true_id])).get(true_id)
+    if category is None:
+        return categories.category_not_found()
+    return categories.category_response(request, response, category)
+
+
+@router.get("/api/clues", response_model=Clues)
+async def clues_list_async(request: Request, response: Response, page: int = 0, after: Union[int, str, None] = None, db=Depends(get_async_db)):
+    query, skip = clues.clues_page_query(page, after)
+    page_clues = await attach_categories(db, await db.clues.find(query).sort("_id").skip(skip).limit(100).to_list(None))
+    return clues.clues_page(request, response, page_clues, page, after, await get_counter(db, "clues.valid") // 100)
+
+
+@router.get("/api/clues/search", response_model=ClueSearch)
+async def search_clues_async(
+    q: str = Query(..., min_length=1),
+    category_id: Union[int, str, None] = None,
+    value: Optional[int] = None,
+    valid: Union[bool, Literal["all"]] = True,
+    after: Optional[str] = None,
+    limit: int = Query(25, ge=1, le=100),
+    db=Depends(get_async_db),
+):
+    if valid == "all":
+        valid = None
+    found = await db.clues.aggregate(clues.search_pipeline(q, category_id, value, valid, after, limit)).to_list(None)
+    return clues.search_page(await attach_categories(db, found), valid, limit)
+
+
+@router.post("/api/clues/batch", response_model=ClueBatch)
+async def get_clues_batch_async(batch: ClueBatchIn, db=Depends(get_async_db)):
+    keys = clues.batch_keys(batch.ids)
+    found = {clue["_id"]: clue for clue in await db.clues.find(clues.batch_query(keys)).to_list(None)}
+    await attach_categories(db, list(found.values()))
+    return clues.batch_result(batch.ids, keys, found)
+
+
+@router.get(
+    "/api/clues/{clue_id}",
+    response_model=ClueOut,
+    responses={404: {"model": Message}},
+)
+async def get_clue_async(clue_id: Union[int, str], request: Request, response: Response, db=Depends(get_async_db)):
+    if isinstance(clue_id, str):
+        true_id = bson.objectid.ObjectId(clue_id)
+    else:
+        true_id = clue_id
+    result, known = clues.local_clue(true_id)
+    if not known:
+        result = await db.clues.find_one(clues.valid_clue_query(true_id))
+    if result is None:
+        return clues.clue_not_found()
+    return clues.clue_response(request, response, (await attach_categories(db, [result]))[0])
+
+
+@router.get(
+    "/api/random-clue",
+    response_model=ClueOut,
+    responses={404: {"model": Message}},
+)
+async def get_random_clue_async(valid: bool = True, db=Depends(get_async_db)):
+    result = None
+    if valid == True:
+        result = clues.random_local()
+        if result is None:
+            for clue_id in clues.random_ids():
+                result = await db.clues.find_one(clues.valid_clue_query(clue_id))
+                if result is not None:
+                    break
+        if result is None:
+            result = (await db.clues.aggregate(clues.sample_pipeline(True)).to_list(1))[0]
+    else:
+        result = (await db.clues.aggregate(clues.sample_pipeline(False)).to_list(1))[0]
+    return clues.with_id((await attach_categories(db, [result]))[0])
+
+
+@router.get("/api/games", response_model=Games)
+async def games_list_async(request: Request, response: Response, page: int = 0, after: Union[int, str, None] = None, db=Depends(get_async_db)):
+    query, skip = games.games_page_query(page, after)
+    page_games = await db.games.find(query).sort("_id").skip(skip).limit(100).to_list(None)
+    stats = await game_stats(db, [game["_id"] for game in page_games])
+    return games.games_page(request, response, page_games, stats, page, after, await get_counter(db, "games") // 100)
+
+
+@router.get(
+    "/api/games/{game_id}",
+    response_model=GameOut,
+    responses={404: {"model": Message}},
+)
+async def get_game_async(game_id: Union[int, str], request: Request, response: Response, db=Depends(get_async_db)):
+    if isinstance(game_id, str):
+        true_id = bson.objectid.ObjectId(game_id)
+    else:
+        true_id = game_id
+    result = await db.games.find_one({"_id": true_id})
+    if result is None:
+        return games.game_not_found()
+    return games.game_response(request, response, result, await game_stats(db, [true_id]))
+
+
+@router.get(
+    "/api/custom-games/{custom_game_id}",
+    response_model=CustomGameOut,
+    responses={404: {"model": Message}},
+)
+async def get_custom_game_async(custom_game_id: Union[int, str], request: Request, response: Response, db=Depends(get_async_db)):
+    if isinstance(custom_game_id, str):
+        true_id = bson.objectid.ObjectId(custom_game_id)
+    else:
+        true_id = custom_game_id
+    result = await db.game_definitions.find_one(games.custom_game_query(true_id))
+    game_defs = linked = None
+    if "clues" not in result:
+        game_defs = await db.game_definition_clues.find({'game_definition_id': result['_id']}).sort("_id").to_list(None)
+        linked = {c['_id']: c for c in await db.clues.find(games.linked_clues_query(game_defs)).to_list(None)}
+        await attach_categories(db, list(linked.values()))
+    return games.custom_game_response(request, response, result, game_defs, linked)
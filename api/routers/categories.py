@@ -1,16 +1,21 @@
-from fastapi import APIRouter, Response, status
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import Union
+from typing import Optional, Union
+from cache import TTLCache
+from bson import json_util
+from database import get_db
+from pymongo import ReturnDocument
 import psycopg
-import os
+import base64
 import bson
-import pymongo
+import catalog
+import conditional
+import counters
+import os
+import snapshots
 
-dbhost = os.environ['MONGOHOST']
-dbname = os.environ['MONGODATABASE']
-dbuser = os.environ['MONGOUSER']
-dbpass = os.environ['MONGOPASSWORD']
-mongo_str = f"mongodb://{dbuser}:{dbpass}@{dbhost}"
 
 # Using routers for organization
 # See https://fastapi.tiangolo.com/tutorial/bigger-applications/
@@ -36,48 +41,201 @@ class  CategoryWithClueCount(BaseModel):
 class Categories(BaseModel):
     page_count: int
     categories: list[CategoryWithClueCount]
+    next_cursor: Optional[str] = None
 
 
 class Message(BaseModel):
     message: str
 
-@router.get("/api/categories", response_model=Categories)
-def categories_list(page: int = 0):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
-    categories = db.categories.find().sort("title").skip(100*page).limit(100)
-    categories = list(categories)
+
+# Categories are small and rarely change, so every router reads them
+# through this cache. The write endpoints below keep it up to date.
+category_cache = TTLCache(
+    maxsize=int(os.environ.get('CATEGORY_CACHE_SIZE', 50000)),
+    ttl=float(os.environ.get('CATEGORY_CACHE_TTL', 300)),
+)
+
+
+def cache_category(category):
+    category["id"] = str(category["_id"])
+    category_cache.set(category.pop("_id"), category)
+    return dict(category)
+
+
+def cached_categories(category_ids):
+    # Copies of the cached categories, and the ids that still have to be
+    # read.
+    categories = {}
+    missing = []
+    for category_id in set(category_ids):
+        category = category_cache.get(category_id)
+        if category is None:
+            missing.append(category_id)
+        else:
+            categories[category_id] = dict(category)
+    return categories, missing
+
+
+def add_categories(categories, found):
+    for category in found:
+        category_id = category["_id"]
+        categories[category_id] = cache_category(category)
+    return categories
+
+
+def load_categories(db, category_ids):
+    # Cached categories first, then one $in query for whatever is left,
+    # instead of a find_one per clue. Callers get their own copies.
+    categories, missing = cached_categories(category_ids)
+    if missing:
+        add_categories(categories, db.categories.find({"_id": {"$in": missing}}))
+    return categories
+
+
+def uncategorized(clues):
+    # Clues carry a snapshot of their category (see snapshots.py); only
+    # clues written without one are looked up, with one $in between them.
+    return [clue["category_id"] for clue in clues if "category" not in clue]
+
+
+def set_categories(clues, categories):
+    for clue in clues:
+        if "category" not in clue:
+            clue["category"] = categories[clue["category_id"]]
+        del clue["category_id"]
+    return clues
+
+
+def attach_categories(db, clues):
+    return set_categories(clues, load_categories(db, uncategorized(clues)))
+
+
+def count_clues_pipeline(category_ids):
+    # Single $group over the page's categories instead of a count per category.
+    return [
+        {"$match": {"category_id": {"$in": list(category_ids)}}},
+        {"$group": {"_id": "$category_id", "n": {"$sum": 1}}},
+    ]
+
+
+def count_clues(db, category_ids):
+    if not category_ids:
+        return {}
+    return {count["_id"]: count["n"] for count in db.clues.aggregate(count_clues_pipeline(category_ids))}
+
+def encode_cursor(*key):
+    # Opaque keyset cursor; json_util keeps ObjectIds apart from strings.
+    return base64.urlsafe_b64encode(json_util.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor, size=2):
+    # A cursor that was not made by encode_cursor is the client's mistake.
+    try:
+        key = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, bson.errors.BSONError):
+        key = None
+    if not isinstance(key, list) or len(key) != size:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Malformed cursor")
+    return key
+
+
+def decode_id(value, name="cursor"):
+    # An _id passed as a query parameter: ints as they are, strings as
+    # ObjectIds. Anything else is a 422, like a malformed cursor.
+    if not isinstance(value, str):
+        return value
+    if not bson.objectid.ObjectId.is_valid(value):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Malformed {name}")
+    return bson.objectid.ObjectId(value)
+
+
+# Queries are built and responses shaped outside the route functions, so
+# the Motor versions in routers/aio.py run the same code.
+CATEGORY_ORDER = [("title", 1), ("_id", 1)]
+
+
+def categories_page_query(page, after):
+    # Keyset pagination when a cursor is given: seek on the (title, _id)
+    # index instead of skipping over every earlier page. Returns the
+    # filter and how many categories to skip.
+    if after is not None:
+        title, last_id = decode_cursor(after)
+        return {"$or": [
+            {"title": {"$gt": title}},
+            {"title": title, "_id": {"$gt": last_id}},
+        ]}, 0
+    return {}, 100*page
+
+
+def check_categories_page(request, response, categories, page, after, page_count):
+    # Tagged from the page's categories and the count this worker caches,
+    # so a 304 costs the page query alone.
+    tag = conditional.etag("categories", page, after, page_count, [
+        (str(category["_id"]), conditional.version(category), category.get("num_clues")) for category in categories
+    ])
+    return conditional.check(request, response, "category_list", tag, conditional.last_modified(*categories))
+
+
+def uncounted(categories):
+    # num_clues is maintained on each category by counters.reconcile; only
+    # categories it has not reached yet are counted per page.
+    return [category["_id"] for category in categories if "num_clues" not in category]
+
+
+def categories_page(categories, counts, page_count):
+    next_cursor = None
+    if len(categories) == 100:
+        # Titles repeat, so the cursor carries the _id as a tie breaker.
+        next_cursor = encode_cursor(categories[-1]["title"], categories[-1]["_id"])
     for category in categories:
-        count = db.command({
-            "count": "clues",
-            "query": { "category_id": category["_id"] }
-        })
-        category["num_clues"] = count["n"]
+        if "num_clues" not in category:
+            category["num_clues"] = counts.get(category["_id"], 0)
         category["id"] = str(category["_id"])
         del category["_id"]
-    page_count = db.command({"count": "categories"})["n"] // 100
     return {
         "page_count": page_count,
         "categories": categories,
+        "next_cursor": next_cursor,
     }
 
 
+def category_not_found():
+    return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Category not found"})
+
+
+def category_response(request, response, category):
+    tag = conditional.etag("category", category["id"], conditional.version(category))
+    not_modified = conditional.check(request, response, "category", tag, conditional.last_modified(category))
+    if not_modified:
+        return not_modified
+    return category
+
+
+@router.get("/api/categories", response_model=Categories)
+def categories_list(request: Request, response: Response, page: int = 0, after: Optional[str] = None, db=Depends(get_db)):
+    query, skip = categories_page_query(page, after)
+    categories = list(db.categories.find(query).sort(CATEGORY_ORDER).skip(skip).limit(100))
+    page_count = counters.get(db, "categories") // 100
+    not_modified = check_categories_page(request, response, categories, page, after, page_count)
+    if not_modified:
+        return not_modified
+    return categories_page(categories, count_clues(db, uncounted(categories)), page_count)
+
+
 @router.get(
     "/api/categories/{category_id}",
     response_model=CategoryOut,
     responses={404: {"model": Message}},
 )
-def get_category(category_id: Union[int, str]):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
+def get_category(category_id: Union[int, str], request: Request, response: Response, db=Depends(get_db)):
     if isinstance(category_id, str):
         true_id = bson.objectid.ObjectId(category_id)
     else:
         true_id = category_id
-    result = db.categories.find_one({"_id": true_id})
-    result["id"] = str(result["_id"])
-    del result["_id"]
-    return result
+    category = load_categories(db, [true_id]).get(true_id)
+    if category is None:
+        return category_not_found()
+    return category_response(request, response, category)
 
 
 @router.post(
@@ -85,14 +243,11 @@ def get_category(category_id: Union[int, str]):
     response_model=CategoryOut,
     responses={409: {"model": Message}},
 )
-def create_category(category: CategoryIn):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
-    cat = db.categories.insert_one({'title': category.title, "canon": False})
-    return_cat = db.categories.find_one({'_id': cat.inserted_id})
-    return_cat['id'] = str(cat.inserted_id)
-    del return_cat["_id"]
-    return return_cat
+def create_category(category: CategoryIn, db=Depends(get_db)):
+    return_cat = {'title': category.title, "canon": False, "num_clues": 0, "version": 1, "updated_on": datetime.utcnow()}
+    db.categories.insert_one(return_cat)
+    counters.incr(db, "categories")
+    return cache_category(return_cat)
     # with psycopg.connect() as conn:
     #     with conn.cursor() as cur:
     #         try:
@@ -125,17 +280,20 @@ def create_category(category: CategoryIn):
     response_model=CategoryOut,
     responses={404: {"model": Message}},
 )
-def update_category(category_id: Union[int,str], category: CategoryIn, response: Response):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
+def update_category(category_id: Union[int,str], category: CategoryIn, response: Response, db=Depends(get_db)):
     if isinstance(category_id, str):
         true_id = bson.objectid.ObjectId(category_id)
     else:
         true_id = category_id
-    db.categories.update_one({"_id":true_id},{ '$set': {'title': category.title},})
-    return_cat = db.categories.find_one({'_id': true_id})
-    return_cat['id'] = return_cat['_id']
-    del return_cat["_id"]
+    return_cat = db.categories.find_one_and_update(
+        {"_id":true_id},
+        { '$set': {'title': category.title, 'updated_on': datetime.utcnow()}, '$inc': {'version': 1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    return_cat = cache_category(return_cat)
+    # The clues' embedded copies are rewritten in the background.
+    snapshots.queue(true_id, return_cat)
+    catalog.touch(db)
     return return_cat
 
     # with psycopg.connect() as conn:
@@ -156,9 +314,7 @@ def update_category(category_id: Union[int,str], category: CategoryIn, response:
     response_model=Message,
     responses={400: {"model": Message}},
 )
-def remove_category(category_id: Union[int,str]):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
+def remove_category(category_id: Union[int,str], db=Depends(get_db)):
     if isinstance(category_id, str):
         true_id = bson.objectid.ObjectId(category_id)
     else:
@@ -166,7 +322,9 @@ def remove_category(category_id: Union[int,str]):
     return_cat = db.categories.find_one({'_id': true_id})
     return_cat['id'] = return_cat['_id']
     del return_cat["_id"]
-    db.categories.delete_one({"_id":true_id})
+    if db.categories.delete_one({"_id":true_id}).deleted_count:
+        counters.incr(db, "categories", -1)
+    category_cache.delete(true_id)
     return return_cat
     # with psycopg.connect() as conn:
     #     with conn.cursor() as cur:
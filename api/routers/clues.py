@@ -1,18 +1,22 @@
-from fastapi import APIRouter, Response, status
-from pydantic import BaseModel
-from typing import Union
-from routers.categories import CategoryOut
-import os
+from datetime import datetime
+from fastapi import APIRouter, Depends, Query, Request, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, conlist
+from typing import Literal, Optional, Union
+from database import get_db
+from pymongo import ReturnDocument
+from routers.categories import CategoryOut, attach_categories, decode_cursor, decode_id, encode_cursor
+from sampling import valid_clues
 import bson
-import pymongo
+import catalog
+import conditional
+import counters
+import flags
+import json
+import os
 # from categories import CategoryOut
 import psycopg
 
-dbhost = os.environ['MONGOHOST']
-dbname = os.environ['MONGODATABASE']
-dbuser = os.environ['MONGOUSER']
-dbpass = os.environ['MONGOPASSWORD']
-mongo_str = f"mongodb://{dbuser}:{dbpass}@{dbhost}"
 # Using routers for organization
 # See https://fastapi.tiangolo.com/tutorial/bigger-applications/
 router = APIRouter()
@@ -34,32 +38,75 @@ class ClueOut(BaseModel):
 class Clues(BaseModel):
     page_count: int
     clues: list[ClueOut]
+    next_cursor: Optional[str] = None
+
+
+class ClueSearchResult(ClueOut):
+    score: float
+
+
+class ClueSearch(BaseModel):
+    clues: list[ClueSearchResult]
+    next_cursor: Optional[str] = None
+
+
+batch_max_ids = int(os.environ.get('CLUE_BATCH_MAX', 100))
+
+
+class ClueBatchIn(BaseModel):
+    ids: conlist(Union[int, str], max_items=batch_max_ids)
+
+
+class ClueBatch(BaseModel):
+    clues: list[ClueOut]
+    missing: list[str]
+    invalid: list[str]
 
 
 class Message(BaseModel):
     message: str
 
 
-@router.get("/api/clues", response_model=Clues)
-def clues_list(page: int = 0):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
-    clues = db.clues.find({'invalid_count': {"$eq":0}}).sort("_id").skip(100*page).limit(100)
-    clues = list(clues)
-    for clue in clues:
-        category = db.categories.find_one({"_id": clue["category_id"]})
-        db.categories.find()
-        clue["id"] = str(clue["_id"])
-        clue["category"] = category
-        category['id'] = str(category['_id'])
-        del category['_id']
-        del clue["_id"]
-        del clue["category_id"]
-    page_count = db.command({"count": "clues"})["n"] // 100
+# The query building and shaping below is shared with the async routes in
+# routers/aio.py, which differ only in how they wait for the database.
+def with_id(clue):
+    clue["id"] = str(clue["_id"])
+    del clue["_id"]
+    return clue
+
+
+def clues_page_query(page, after):
+    # Keyset pagination when a cursor is given: seek on _id instead of
+    # skipping over every earlier page. Returns the filter and how many
+    # clues to skip.
+    if after is not None:
+        return {'invalid_count': {"$eq":0}, "_id": {"$gt": decode_id(after)}}, 0
+    return {'invalid_count': {"$eq":0}}, 100*page
+
+
+def clues_page(request, response, clues, page, after, page_count):
+    # Tagged from the clues, the category snapshots they carry and the
+    # count this worker caches, so a 304 costs the page query alone.
+    next_cursor = str(clues[-1]["_id"]) if len(clues) == 100 else None
+    clues = [with_id(clue) for clue in clues if not flags.hidden(clue["_id"])]
+    tag = conditional.etag("clues", page, str(after), page_count, [clue_etag_parts(clue) for clue in clues])
+    modified = conditional.last_modified(*clues, *[clue["category"] for clue in clues])
+    not_modified = conditional.check(request, response, "clue_list", tag, modified)
+    if not_modified:
+        return not_modified
     return {
         "page_count": page_count,
         "clues": clues,
+        "next_cursor": next_cursor,
     }
+
+
+@router.get("/api/clues", response_model=Clues)
+def clues_list(request: Request, response: Response, page: int = 0, after: Union[int, str, None] = None, db=Depends(get_db)):
+    query, skip = clues_page_query(page, after)
+    clues = list(db.clues.find(query).sort("_id").skip(skip).limit(100))
+    attach_categories(db, clues)
+    return clues_page(request, response, clues, page, after, counters.get(db, "clues.valid") // 100)
     # # Uses the environment variables to connect
     # # In development, see the docker-compose.yml file for
     # #   the PG settings in the "environment" section
@@ -112,26 +159,213 @@ def clues_list(page: int = 0):
     #         return Clues(page_count=page_count, categories=results)
 
 
+def search_pipeline(q, category_id, value, valid, after, limit):
+    # Served by the text index on question, answer and category title, best
+    # match first. valid=None searches flagged clues too. next_cursor
+    # carries the (score, _id) of the last result so later pages seek past
+    # it instead of re-ranking and skipping.
+    query = {"$text": {"$search": q}}
+    if valid is not None:
+        query["invalid_count"] = {"$eq": 0} if valid else {"$gt": 0}
+    if category_id is not None:
+        query["category_id"] = decode_id(category_id, "category_id")
+    if value is not None:
+        query["value"] = value
+    pipeline = [
+        {"$match": query},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+    ]
+    if after is not None:
+        score, last_id = decode_cursor(after)
+        pipeline.append({"$match": {"$or": [
+            {"score": {"$lt": score}},
+            {"score": score, "_id": {"$gt": last_id}},
+        ]}})
+    return pipeline + [{"$sort": {"score": -1, "_id": 1}}, {"$limit": limit}]
+
+
+def search_page(clues, valid, limit):
+    next_cursor = encode_cursor(clues[-1]["score"], clues[-1]["_id"]) if len(clues) == limit else None
+    if valid:
+        clues = [clue for clue in clues if not flags.hidden(clue["_id"])]
+    clues = [with_id(clue) for clue in clues]
+    return {
+        "clues": clues,
+        "next_cursor": next_cursor,
+    }
+
+
+# Declared before /api/clues/{clue_id} so "search" is not taken for an id.
+@router.get("/api/clues/search", response_model=ClueSearch)
+def search_clues(
+    q: str = Query(..., min_length=1),
+    category_id: Union[int, str, None] = None,
+    value: Optional[int] = None,
+    valid: Union[bool, Literal["all"]] = True,
+    after: Optional[str] = None,
+    limit: int = Query(25, ge=1, le=100),
+    db=Depends(get_db),
+):
+    if valid == "all":
+        valid = None
+    clues = list(db.clues.aggregate(search_pipeline(q, category_id, value, valid, after, limit)))
+    attach_categories(db, clues)
+    return search_page(clues, valid, limit)
+
+
+def batch_keys(ids):
+    # The _id for each requested id, None for malformed ones.
+    keys = []
+    for clue_id in ids:
+        if isinstance(clue_id, str):
+            clue_id = bson.objectid.ObjectId(clue_id) if bson.objectid.ObjectId.is_valid(clue_id) else None
+        keys.append(clue_id)
+    return keys
+
+
+def batch_query(keys):
+    return {"_id": {"$in": [key for key in keys if key is not None]}}
+
+
+def batch_result(ids, keys, found):
+    clues = []
+    missing = []
+    invalid = []
+    for clue_id, key in zip(ids, keys):
+        clue = found.get(key)
+        if clue is None:
+            missing.append(str(clue_id))
+        elif clue["invalid_count"] != 0 or flags.hidden(key):
+            invalid.append(str(clue_id))
+        else:
+            clues.append({
+                "id": str(clue["_id"]),
+                "answer": clue["answer"],
+                "question": clue["question"],
+                "value": clue["value"],
+                "invalid_count": clue["invalid_count"],
+                "category": clue["category"],
+                "canon": clue["canon"],
+            })
+    return {
+        "clues": clues,
+        "missing": missing,
+        "invalid": invalid,
+    }
+
+
+@router.post("/api/clues/batch", response_model=ClueBatch)
+def get_clues_batch(batch: ClueBatchIn, db=Depends(get_db)):
+    # Two queries however many ids: one $in for the clues and one for
+    # their categories. Clues come back in the order they were asked for;
+    # unknown or malformed ids are listed in missing, flagged clues in
+    # invalid, as get_clue would 404 on both. More than CLUE_BATCH_MAX ids
+    # is rejected with a 422 by ClueBatchIn.
+    keys = batch_keys(batch.ids)
+    found = {clue["_id"]: clue for clue in db.clues.find(batch_query(keys))}
+    attach_categories(db, list(found.values()))
+    return batch_result(batch.ids, keys, found)
+
+
+export_batch_size = int(os.environ.get('EXPORT_BATCH_SIZE', 5000))
+
+
+# Declared before /api/clues/{clue_id} so "export" is not taken for an id.
+@router.get("/api/clues/export")
+def export_clues(
+    valid: Optional[bool] = None,
+    canon: Optional[bool] = None,
+    category_id: Union[int, str, None] = None,
+    after: Union[int, str, None] = None,
+    db=Depends(get_db),
+):
+    # One server-side cursor in _id order, streamed as NDJSON so memory
+    # stays flat however many clues there are. Pass the last id you got
+    # as after= to resume an interrupted export.
+    query = {}
+    if valid is not None:
+        query["invalid_count"] = {"$eq": 0} if valid else {"$gt": 0}
+    if canon is not None:
+        query["canon"] = {"$eq": canon}
+    if category_id is not None:
+        query["category_id"] = decode_id(category_id, "category_id")
+    if after is not None:
+        query["_id"] = {"$gt": decode_id(after)}
+    # Categories are small, so load them once instead of joining per clue.
+    categories = {
+        category["_id"]: {"id": str(category["_id"]), "title": category["title"], "canon": category["canon"]}
+        for category in db.categories.find({}, {"title": 1, "canon": 1})
+    }
+
+    def lines():
+        cursor = db.clues.find(query).sort("_id").batch_size(export_batch_size)
+        if category_id is None and valid is not True:
+            # Walk the _id index and filter as we go; the planner might
+            # otherwise pick the canon index and sort the whole match in
+            # memory before the first line goes out.
+            cursor = cursor.hint([("_id", 1)])
+        try:
+            for clue in cursor:
+                yield json.dumps({
+                    "id": str(clue["_id"]),
+                    "answer": clue["answer"],
+                    "question": clue["question"],
+                    "value": clue["value"],
+                    "invalid_count": clue["invalid_count"],
+                    "canon": clue["canon"],
+                    "game_id": str(clue["game_id"]) if "game_id" in clue else None,
+                    "category": categories.get(clue["category_id"]),
+                }) + "\n"
+        finally:
+            cursor.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def local_clue(clue_id):
+    # (clue, True) when the answer is known without a query: None for a
+    # clue hidden by a pending flag, or whatever the mapped catalog has.
+    # (None, False) when the database has to be asked.
+    if flags.hidden(clue_id):
+        return None, True
+    result = catalog.find(clue_id)
+    if result is None:
+        return None, False
+    return (result if result["invalid_count"] == 0 else None), True
+
+
+def valid_clue_query(clue_id):
+    return {"_id": clue_id, 'invalid_count': {"$eq": 0}}
+
+
+def clue_not_found():
+    return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Clue not found"})
+
+
+def clue_response(request, response, result):
+    result = with_id(result)
+    not_modified = conditional.check(request, response, "clue", clue_etag(result), conditional.last_modified(result, result["category"]))
+    if not_modified:
+        return not_modified
+    return result
+
+
 @router.get(
     "/api/clues/{clue_id}",
     response_model=ClueOut,
     responses={404: {"model": Message}},
 )
-def get_clue(clue_id: Union[int, str]):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
+def get_clue(clue_id: Union[int, str], request: Request, response: Response, db=Depends(get_db)):
     if isinstance(clue_id, str):
         true_id = bson.objectid.ObjectId(clue_id)
     else:
         true_id = clue_id
-    result = db.clues.find_one({"$and": [{"_id": true_id}, {'invalid_count': {"$eq": 0}}]})
-    result["id"] = str(result["_id"])
-    del result["_id"]
-    category = db.categories.find_one({"_id": result["category_id"]})
-    category['id']= str(category['_id'])
-    result["category"] = category
-    del result["category_id"]
-    return result
+    result, known = local_clue(true_id)
+    if not known:
+        result = db.clues.find_one(valid_clue_query(true_id))
+    if result is None:
+        return clue_not_found()
+    return clue_response(request, response, attach_categories(db, [result])[0])
 
     # with psycopg.connect() as conn:
     #     with conn.cursor() as cur:
@@ -171,26 +405,62 @@ def get_clue(clue_id: Union[int, str]):
     #         record["category"] = category_object
     #         return record
 
+
+def clue_etag_parts(clue):
+    # A clue's response embeds its category, so a rename changes it too.
+    category = clue["category"]
+    return (clue["id"], conditional.version(clue), category["id"], conditional.version(category))
+
+
+def clue_etag(clue):
+    return conditional.etag("clue", *clue_etag_parts(clue))
+
+
+def sample_pipeline(valid):
+    # An unfiltered $sample uses MongoDB's random cursor already.
+    if valid:
+        return [{"$match": {"invalid_count": {"$eq": 0}}}, {"$sample": {"size": 1}}]
+    return [{"$sample": {"size": 1}}]
+
+
+def random_local():
+    # The mapped catalog first, when there is one.
+    result = catalog.random_valid()
+    if result is not None and flags.hidden(result["_id"]):
+        return None
+    return result
+
+
+def random_ids():
+    # Picks from the in-process pool of valid ids; an id flagged since the
+    # last refresh simply misses and the caller tries the next one.
+    for _ in range(3):
+        clue_id = valid_clues.choice()
+        if clue_id is None:
+            return
+        if not flags.hidden(clue_id):
+            yield clue_id
+
+
 @router.get(
     "/api/random-clue",
     response_model=ClueOut,
     responses={404: {"model": Message}},
 )
-def get_random_clue(valid: bool = True):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
+def get_random_clue(valid: bool = True, db=Depends(get_db)):
+    result = None
     if valid == True:
-        result = list(db.clues.aggregate([{"$match": {"invalid_count": {"$eq": 0}}},{"$sample": {"size": 1}}]))[0]
+        result = random_local()
+        if result is None:
+            for clue_id in random_ids():
+                result = db.clues.find_one(valid_clue_query(clue_id))
+                if result is not None:
+                    break
+        if result is None:
+            result = list(db.clues.aggregate(sample_pipeline(True)))[0]
     else:
-        result = list(db.clues.aggregate([{"$sample": {"size": 1}}]))[0]
-        
-    result["id"] = str(result["_id"])
-    del result["_id"]
-    category = db.categories.find_one({"_id": result["category_id"]})
-    db.categories.find()
-    result["category"] = category
-    del result["category_id"]
-    return result
+        result = list(db.clues.aggregate(sample_pipeline(False)))[0]
+    return with_id(attach_categories(db, [result])[0])
 
     # with psycopg.connect() as conn:
     #     with conn.cursor() as cur:
@@ -308,18 +578,31 @@ def get_random_clue(valid: bool = True):
     response_model=ClueOut,
     responses={404: {"model": Message}},
 )
-def remove_clue(clue_id: Union[int, str]):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
+def remove_clue(clue_id: Union[int, str], db=Depends(get_db)):
     if isinstance(clue_id, str):
         true_id = bson.objectid.ObjectId(clue_id)
     else:
         true_id = clue_id
-    db.clues.update_one({"_id":true_id},{ '$inc': {'invalid_count': 1}})
-    return_cat = db.clues.find_one({'_id': true_id})
-    return_cat['id'] = return_cat['_id']
-    del return_cat["_id"]
-    return return_cat
+    if flags.enabled:
+        # Written behind in batches; flags.flush keeps clues.valid and
+        # game_stats.
+        return_cat = flags.add(db, true_id)
+    else:
+        # Off the catalog before the write lands, not after.
+        catalog.forget([true_id])
+        return_cat = db.clues.find_one_and_update(
+            {"_id":true_id},
+            { '$inc': {'invalid_count': 1, 'version': 1}, '$set': {'updated_on': datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if return_cat is not None and return_cat['invalid_count'] == 1:
+            # First flag, the clue just left the valid set.
+            counters.incr(db, "clues.valid", -1)
+            counters.incr_games(db, "valid_count", {return_cat.get("game_id"): -1})
+            catalog.publish(db, [true_id])
+    if return_cat is None:
+        return clue_not_found()
+    return with_id(attach_categories(db, [return_cat])[0])
     # with psycopg.connect() as conn:
     #     with conn.cursor() as cur:
     #         try:
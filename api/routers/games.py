@@ -1,17 +1,18 @@
 from datetime import datetime
-from fastapi import APIRouter, Response, status
+from fastapi import APIRouter, Depends, Request, Response, status
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import Union
+from typing import Optional, Union
+from database import get_db
+from routers.categories import attach_categories, decode_id
+import catalog
+import conditional
+import counters
+import game_pool
 import psycopg
 import os
 import bson
-import pymongo
 
-dbhost = os.environ['MONGOHOST']
-dbname = os.environ['MONGODATABASE']
-dbuser = os.environ['MONGOUSER']
-dbpass = os.environ['MONGOPASSWORD']
-mongo_str = f"mongodb://{dbuser}:{dbpass}@{dbhost}"
 
 # Using routers for organization
 # See https://fastapi.tiangolo.com/tutorial/bigger-applications/
@@ -38,7 +39,10 @@ class GameOut(BaseModel):
     episode_id: int
     aired: str
     canon: bool
+    # Summed value of the game's clues.
     total_amount_won: int
+    clue_count: int
+    valid_count: int
 
 class CustomGameIn(BaseModel):
     created_on: str
@@ -52,31 +56,101 @@ class Message(BaseModel):
     message: str
 
 class Games(BaseModel):
+    page_count: int
     games: list[GameOut]
+    next_cursor: Optional[str] = None
+
+
+# With CUSTOM_GAME_SNAPSHOT=1 new game definitions embed their hydrated
+# clues, so get_custom_game is a single document read. The snapshot keeps
+# the clue and category as they were when the game was created.
+custom_game_snapshot = os.environ.get('CUSTOM_GAME_SNAPSHOT', '0') == '1'
+
+
+def custom_game_clue(clue, category):
+    return {
+        '_id': clue['_id'],
+        'id': str(clue['_id']),
+        'answer': clue['answer'],
+        'question': clue['question'],
+        'value': clue['value'],
+        'invalid_count': clue['invalid_count'],
+        'category': {'id': category['id'], 'title': category['title']},
+    }
+
+def with_stats(game, stats):
+    game["id"] = str(game.pop("_id"))
+    game["total_amount_won"] = stats["total_value"]
+    game["clue_count"] = stats["clue_count"]
+    game["valid_count"] = stats["valid_count"]
+    return game
+
+
+def game_etag_parts(game):
+    return (game["id"], conditional.version(game), game["total_amount_won"], game["clue_count"], game["valid_count"])
+
+
+# Shared with the Motor versions of these routes in routers/aio.py.
+def games_page_query(page, after):
+    # Same paging as clues_list: keyset on _id when a cursor is given.
+    # Returns the filter and how many games to skip.
+    if after is not None:
+        return {"_id": {"$gt": decode_id(after)}}, 0
+    return {}, 100*page
+
+
+def games_page(request, response, games, stats, page, after, page_count):
+    next_cursor = str(games[-1]["_id"]) if len(games) == 100 else None
+    games = [with_stats(game, stats[game["_id"]]) for game in games]
+    tag = conditional.etag("games", page, str(after), page_count, [game_etag_parts(game) for game in games])
+    not_modified = conditional.check(request, response, "game_list", tag, conditional.last_modified(*games))
+    if not_modified:
+        return not_modified
+    return {
+        "page_count": page_count,
+        "games": games,
+        "next_cursor": next_cursor,
+    }
+
+
+def game_not_found():
+    return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Game not found"})
+
+
+def game_response(request, response, result, stats):
+    result = with_stats(result, stats[result["_id"]])
+    tag = conditional.etag("game", *game_etag_parts(result))
+    not_modified = conditional.check(request, response, "game", tag, conditional.last_modified(result))
+    if not_modified:
+        return not_modified
+    return result
+
+
+@router.get("/api/games", response_model=Games)
+def games_list(request: Request, response: Response, page: int = 0, after: Union[int, str, None] = None, db=Depends(get_db)):
+    query, skip = games_page_query(page, after)
+    games = list(db.games.find(query).sort("_id").skip(skip).limit(100))
+    # Per-game totals come from game_stats, one $in for the page.
+    stats = counters.game_stats(db, [game["_id"] for game in games])
+    return games_page(request, response, games, stats, page, after, counters.get(db, "games") // 100)
+
 
 @router.get(
     "/api/games/{game_id}",
     response_model=GameOut,
     responses={404: {"model": Message}},
 )
-def get_game(game_id: Union[int, str]):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
+def get_game(game_id: Union[int, str], request: Request, response: Response, db=Depends(get_db)):
     if isinstance(game_id, str):
         true_id = bson.objectid.ObjectId(game_id)
     else:
         true_id = game_id
     result = db.games.find_one({"_id": true_id})
-    result["id"] = str(result["_id"])
-    clue = db.command(
-       {
-            "count": "clues",
-            "query": {"game_id": result['_id']}
-        }
-    )
-    result['total_amount_won'] = clue['n']
-    del result["_id"]
-    return result
+    if result is None:
+        # Before game_stats, which would build stats for the missing game.
+        return game_not_found()
+    # Precomputed in game_stats instead of counting the game's clues.
+    return game_response(request, response, result, counters.game_stats(db, [true_id]))
     # with psycopg.connect() as conn:
     #     with conn.cursor() as cur:
     #         cur.execute(
@@ -104,31 +178,46 @@ def get_game(game_id: Union[int, str]):
     #             record[column.name] = row[i]
     #         return record
 
+
 @router.post(
     "/api/custom-games",
     response_model=CustomGameOut,
     responses={409: {"model": Message}},
 )
-def create_custom_game():
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
-    with client.start_session() as session:
-        with session.start_transaction():
-            cat = db.game_definitions.insert_one({'created_on': datetime.utcnow()})
-            return_cat = db.game_definitions.find_one({'_id': cat.inserted_id})
-            return_cat['id'] = str(return_cat['_id'])
-            clues = list(db.clues.aggregate([{"$match": {"canon": {"$eq": True}}},{"$sample": {"size": 30}}]))
-            for clue in clues:
-                clue['id'] = str(clue['_id'])
-                category = db.categories.find_one({"_id": clue["category_id"]})
-                db.categories.find()
-                clue["category"] = category
-                del clue["category_id"]
-                db.game_definition_clues.insert_one({'game_definition_id': return_cat['_id'],'clue_id': clue['_id']})
-                del clue['_id']
-            return_cat['clues'] = clues
-            del return_cat["_id"]
-            return return_cat
+def create_custom_game(db=Depends(get_db)):
+    return_cat = game_pool.claim(db, custom_game_snapshot)
+    if return_cat is None:
+        return_cat = build_custom_game(db)
+    for clue in return_cat['clues']:
+        clue.pop('_id', None)
+    return_cat['id'] = str(return_cat['_id'])
+    del return_cat["_id"]
+    return return_cat
+
+
+def build_custom_game(db, pooled=False):
+    # Sampled from the mapped catalog when there is one.
+    clues = catalog.sample_canon(30)
+    if clues is None:
+        clues = list(db.clues.aggregate([{"$match": {"canon": {"$eq": True}}},{"$sample": {"size": 30}}]))
+    clues = [custom_game_clue(clue, clue["category"]) for clue in attach_categories(db, clues)]
+    # No transaction: the mongo service is a standalone server, which has
+    # none. The link rows go in first under an _id chosen here, so the game
+    # is never visible without them; a failure in between leaves only link
+    # rows no game points to.
+    return_cat = {'_id': bson.objectid.ObjectId(), 'created_on': datetime.utcnow()}
+    if pooled:
+        # Waiting in game_pool; claiming it stamps created_on.
+        return_cat['pooled'] = True
+    if custom_game_snapshot or pooled:
+        return_cat['clues'] = clues
+    db.game_definition_clues.insert_many(
+        [{'game_definition_id': return_cat['_id'], 'clue_id': clue['_id']} for clue in clues],
+        ordered=False,
+    )
+    db.game_definitions.insert_one(return_cat)
+    return_cat['clues'] = clues
+    return return_cat
 #     with psycopg.connect() as conn:
 #         with conn.cursor() as cur:
 #             try:
@@ -187,34 +276,58 @@ def create_custom_game():
 #             for i, column in enumerate(cur.description):
 #                 record[column.name] = row[i]
 #             return record
+def custom_game_query(custom_game_id):
+    # Games still waiting in the pool have not been handed out yet.
+    return {"_id": custom_game_id, "pooled": {"$exists": False}}
+
+
+def linked_clues_query(game_defs):
+    return {'_id': {"$in": [game_def['clue_id'] for game_def in game_defs]}}
+
+
+def custom_game_response(request, response, result, game_defs, clues):
+    # game_defs and clues are the link rows and their clues, for games
+    # that embed no snapshot of their clues. Snapshots are fixed when the
+    # game is created; linked games show their clues and categories as
+    # they are now.
+    result["id"] = str(result["_id"])
+    parts = []
+    sources = [result]
+    if game_defs is not None:
+        parts = sorted((str(c['_id']), conditional.version(c), c['category']['id'], conditional.version(c['category']))
+                       for c in clues.values())
+        sources += list(clues.values()) + [c['category'] for c in clues.values()]
+    tag = conditional.etag("custom_game", result["id"], result["created_on"], parts)
+    not_modified = conditional.check(request, response, "custom_game", tag, conditional.last_modified(*sources))
+    if not_modified:
+        return not_modified
+    if game_defs is not None:
+        result['clues'] = [
+            custom_game_clue(clues[game_def['clue_id']], clues[game_def['clue_id']]['category'])
+            for game_def in game_defs
+        ]
+    del result["_id"]
+    return result
+
+
 @router.get(
     "/api/custom-games/{custom_game_id}",
     response_model=CustomGameOut,
     responses={404: {"model": Message}},
 )
-def get_custom_game(custom_game_id: Union[int, str]):
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
+def get_custom_game(custom_game_id: Union[int, str], request: Request, response: Response, db=Depends(get_db)):
     if isinstance(custom_game_id, str):
         true_id = bson.objectid.ObjectId(custom_game_id)
     else:
         true_id = custom_game_id
-    result = db.game_definitions.find_one({"_id": true_id})
-    result["id"] = str(result["_id"])
-    game_defs = list(db.game_definition_clues.find({'game_definition_id': result['_id']}))
-    clues = []
-    for game_def in game_defs:
-        c = db.clues.find_one({'_id': game_def['clue_id']})
-        c['id'] = str(c['_id'])
-        category = db.categories.find_one({"_id": c["category_id"]})
-        del category['canon']
-        c["category"] = category
-        category['id'] = str(category["_id"])
-        del c["canon"]
-        del c["game_id"]
-        del c["category_id"]
-        del c['_id']
-        clues.append(c)
-    result['clues'] = clues
-    del result["_id"]
-    return result
\ No newline at end of file
+    result = db.game_definitions.find_one(custom_game_query(true_id))
+    game_defs = clues = None
+    if "clues" not in result:
+        # Link rows come back in insertion order; fetch their clues and
+        # categories with one $in each and put them back in that order.
+        game_defs = list(db.game_definition_clues.find({'game_definition_id': result['_id']}).sort("_id"))
+        clues = {c['_id']: c for c in db.clues.find(linked_clues_query(game_defs))}
+        # Clues carry their category snapshot; only those without one are
+        # looked up, before the tag.
+        attach_categories(db, list(clues.values()))
+    return custom_game_response(request, response, result, game_defs, clues)
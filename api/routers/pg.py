@@ -0,0 +1,327 @@
+from fastapi import APIRouter, Depends, Request, Response, status
+from fastapi.responses import JSONResponse
+from typing import Optional
+from cache import TTLCache
+from database import get_pg
+from routers.categories import Categories, CategoryIn, CategoryOut, Message, decode_cursor, encode_cursor
+from routers.clues import ClueBatch, ClueBatchIn, ClueOut, Clues
+from routers.games import GameOut, Games
+import conditional
+import counters
+import psycopg
+
+# Postgres versions of the clue, category and game routes, served from the
+# jService database when STORAGE_BACKEND=postgres. main.py registers the
+# MongoDB routes first and then swaps these in at the same paths and
+# positions (include_overrides); search, export and custom games stay on
+# MongoDB.
+#
+# Every read is a single statement joining what the response needs. The
+# pool in database.py prepares each statement on first use, so repeat
+# requests skip parsing and planning.
+router = APIRouter()
+
+CLUE_COLUMNS = """
+    clues.id, clues.answer, clues.question, clues.value, clues.invalid_count, clues.canon,
+    categories.id AS category_id, categories.title AS category_title, categories.canon AS category_canon
+"""
+CLUE_FROM = "FROM clues JOIN categories ON categories.id = clues.category_id"
+
+CLUES = f"""
+    SELECT {CLUE_COLUMNS} {CLUE_FROM}
+    WHERE clues.invalid_count = 0 {{where}}
+    ORDER BY clues.id LIMIT 100 {{offset}}
+"""
+CLUES_PAGE = CLUES.format(where="", offset="OFFSET %s")
+CLUES_AFTER = CLUES.format(where="AND clues.id > %s", offset="")
+CLUE = f"SELECT {CLUE_COLUMNS} {CLUE_FROM} WHERE clues.id = %s AND clues.invalid_count = 0"
+CLUES_BY_ID = f"SELECT {CLUE_COLUMNS} {CLUE_FROM} WHERE clues.id = ANY(%s)"
+# Seeks to a random point in the id range through the primary key instead
+# of ORDER BY RANDOM(), which sorts the whole table. Clues after a gap in
+# the ids are a little more likely to be picked.
+RANDOM_CLUE = f"""
+    SELECT {CLUE_COLUMNS} {CLUE_FROM}
+    WHERE clues.id >= (SELECT min(id) + floor(random() * (max(id) - min(id) + 1))::int FROM clues) {{where}}
+    ORDER BY clues.id LIMIT 1
+"""
+RANDOM_VALID_CLUE = RANDOM_CLUE.format(where="AND clues.invalid_count = 0")
+RANDOM_ANY_CLUE = RANDOM_CLUE.format(where="")
+FIRST_VALID_CLUE = f"SELECT {CLUE_COLUMNS} {CLUE_FROM} WHERE clues.invalid_count = 0 ORDER BY clues.id LIMIT 1"
+FIRST_ANY_CLUE = f"SELECT {CLUE_COLUMNS} {CLUE_FROM} ORDER BY clues.id LIMIT 1"
+FLAG_CLUE = f"""
+    UPDATE clues SET invalid_count = coalesce(clues.invalid_count, 0) + 1
+    FROM categories
+    WHERE clues.id = %s AND categories.id = clues.category_id
+    RETURNING {CLUE_COLUMNS}
+"""
+
+CATEGORIES = """
+    SELECT page.id, page.title, page.canon, counts.num_clues
+    FROM (SELECT id, title, canon FROM categories {where} ORDER BY title, id LIMIT 100 {offset}) AS page
+    CROSS JOIN LATERAL (SELECT count(*) AS num_clues FROM clues WHERE clues.category_id = page.id) AS counts
+    ORDER BY page.title, page.id
+"""
+CATEGORIES_PAGE = CATEGORIES.format(where="", offset="OFFSET %s")
+CATEGORIES_AFTER = CATEGORIES.format(where="WHERE (title, id) > (%s, %s)", offset="")
+CATEGORY = "SELECT id, title, canon FROM categories WHERE id = %s"
+CREATE_CATEGORY = "INSERT INTO categories (title, canon) VALUES (%s, false) RETURNING id, title, canon"
+UPDATE_CATEGORY = "UPDATE categories SET title = %s WHERE id = %s RETURNING id, title, canon"
+DELETE_CATEGORY = "DELETE FROM categories WHERE id = %s"
+
+GAME_TOTALS = """
+    SELECT count(clues.id) AS clue_count,
+        coalesce(sum(clues.value), 0) AS total_amount_won,
+        count(clues.id) FILTER (WHERE clues.invalid_count = 0) AS valid_count
+    FROM clues WHERE clues.game_id = {game}
+"""
+GAMES = f"""
+    SELECT page.id, page.episode_id, coalesce(page.aired::text, '') AS aired, page.canon, totals.*
+    FROM (SELECT id, episode_id, aired, canon FROM games {{where}} ORDER BY id LIMIT 100 {{offset}}) AS page
+    CROSS JOIN LATERAL ({GAME_TOTALS.format(game="page.id")}) AS totals
+    ORDER BY page.id
+"""
+GAMES_PAGE = GAMES.format(where="", offset="OFFSET %s")
+GAMES_AFTER = GAMES.format(where="WHERE id > %s", offset="")
+GAME = f"""
+    SELECT games.id, games.episode_id, coalesce(games.aired::text, '') AS aired, games.canon, totals.*
+    FROM games CROSS JOIN LATERAL ({GAME_TOTALS.format(game="games.id")}) AS totals
+    WHERE games.id = %s
+"""
+
+COUNTS = {
+    "clues.valid": "SELECT count(*) AS n FROM clues WHERE invalid_count = 0",
+    "categories": "SELECT count(*) AS n FROM categories",
+    "games": "SELECT count(*) AS n FROM games",
+}
+_counts = TTLCache(maxsize=len(COUNTS), ttl=counters.cache_seconds)
+
+
+def count(conn, name):
+    # Page counts, cached like the MongoDB counters.
+    n = _counts.get(name)
+    if n is None:
+        n = conn.execute(COUNTS[name]).fetchone()["n"]
+        _counts.set(name, n)
+    return n
+
+
+def clue_out(row):
+    return {
+        "id": str(row["id"]),
+        "answer": row["answer"],
+        "question": row["question"],
+        "value": row["value"] or 0,
+        "invalid_count": row["invalid_count"] or 0,
+        "canon": bool(row["canon"]),
+        "category": {"id": str(row["category_id"]), "title": row["category_title"], "canon": bool(row["category_canon"])},
+    }
+
+
+def row_out(row):
+    row["id"] = str(row["id"])
+    return row
+
+
+def not_found(message):
+    return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": message})
+
+
+def row_etag(kind, rows, *parts):
+    # No version column here, so the validator covers the rows themselves.
+    return conditional.etag(kind, *parts, [tuple(row.values()) for row in rows])
+
+
+@router.get("/api/clues", response_model=Clues)
+def clues_list_pg(request: Request, response: Response, page: int = 0, after: Optional[int] = None, conn=Depends(get_pg)):
+    if after is not None:
+        rows = conn.execute(CLUES_AFTER, [after]).fetchall()
+    else:
+        rows = conn.execute(CLUES_PAGE, [100 * page]).fetchall()
+    page_count = count(conn, "clues.valid") // 100
+    not_modified = conditional.check(request, response, "clue_list", row_etag("clues", rows, page, after, page_count))
+    if not_modified:
+        return not_modified
+    return {
+        "page_count": page_count,
+        "clues": [clue_out(row) for row in rows],
+        "next_cursor": str(rows[-1]["id"]) if len(rows) == 100 else None,
+    }
+
+
+@router.post("/api/clues/batch", response_model=ClueBatch)
+def get_clues_batch_pg(batch: ClueBatchIn, conn=Depends(get_pg)):
+    # Same contract as the MongoDB version; ids are integers here.
+    keys = [int(clue_id) if str(clue_id).isdigit() else None for clue_id in batch.ids]
+    found = {row["id"]: row for row in conn.execute(CLUES_BY_ID, [[key for key in keys if key is not None]])}
+    clues = []
+    missing = []
+    invalid = []
+    for clue_id, key in zip(batch.ids, keys):
+        row = found.get(key)
+        if row is None:
+            missing.append(str(clue_id))
+        elif row["invalid_count"]:
+            invalid.append(str(clue_id))
+        else:
+            clues.append(clue_out(row))
+    return {
+        "clues": clues,
+        "missing": missing,
+        "invalid": invalid,
+    }
+
+
+@router.get(
+    "/api/clues/{clue_id}",
+    response_model=ClueOut,
+    responses={404: {"model": Message}},
+)
+def get_clue_pg(clue_id: int, request: Request, response: Response, conn=Depends(get_pg)):
+    row = conn.execute(CLUE, [clue_id]).fetchone()
+    if row is None:
+        return not_found("Clue not found")
+    not_modified = conditional.check(request, response, "clue", row_etag("clue", [row]))
+    if not_modified:
+        return not_modified
+    return clue_out(row)
+
+
+@router.get(
+    "/api/random-clue",
+    response_model=ClueOut,
+    responses={404: {"model": Message}},
+)
+def get_random_clue_pg(valid: bool = True, conn=Depends(get_pg)):
+    row = conn.execute(RANDOM_VALID_CLUE if valid else RANDOM_ANY_CLUE).fetchone()
+    if row is None:
+        # The random point fell after the last matching clue; wrap around.
+        row = conn.execute(FIRST_VALID_CLUE if valid else FIRST_ANY_CLUE).fetchone()
+    if row is None:
+        return not_found("Clue not found")
+    return clue_out(row)
+
+
+@router.put(
+    "/api/clues/{clue_id}",
+    response_model=ClueOut,
+    responses={404: {"model": Message}},
+)
+def remove_clue_pg(clue_id: int, conn=Depends(get_pg)):
+    # Committed before the response goes out, and before the cached count
+    # is dropped so no request can cache the old one again.
+    with conn.transaction():
+        row = conn.execute(FLAG_CLUE, [clue_id]).fetchone()
+    if row is None:
+        return not_found("Clue not found")
+    if row["invalid_count"] == 1:
+        # First flag, the clue just left the valid set.
+        _counts.delete("clues.valid")
+    return clue_out(row)
+
+
+@router.get("/api/categories", response_model=Categories)
+def categories_list_pg(request: Request, response: Response, page: int = 0, after: Optional[str] = None, conn=Depends(get_pg)):
+    if after is not None:
+        rows = conn.execute(CATEGORIES_AFTER, decode_cursor(after)).fetchall()
+    else:
+        rows = conn.execute(CATEGORIES_PAGE, [100 * page]).fetchall()
+    next_cursor = encode_cursor(rows[-1]["title"], rows[-1]["id"]) if len(rows) == 100 else None
+    page_count = count(conn, "categories") // 100
+    not_modified = conditional.check(request, response, "category_list", row_etag("categories", rows, page, after, page_count))
+    if not_modified:
+        return not_modified
+    return {
+        "page_count": page_count,
+        "categories": [row_out(row) for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+@router.get(
+    "/api/categories/{category_id}",
+    response_model=CategoryOut,
+    responses={404: {"model": Message}},
+)
+def get_category_pg(category_id: int, request: Request, response: Response, conn=Depends(get_pg)):
+    row = conn.execute(CATEGORY, [category_id]).fetchone()
+    if row is None:
+        return not_found("Category not found")
+    not_modified = conditional.check(request, response, "category", row_etag("category", [row]))
+    if not_modified:
+        return not_modified
+    return row_out(row)
+
+
+@router.post(
+    "/api/categories",
+    response_model=CategoryOut,
+    responses={409: {"model": Message}},
+)
+def create_category_pg(category: CategoryIn, conn=Depends(get_pg)):
+    try:
+        with conn.transaction():
+            row = conn.execute(CREATE_CATEGORY, [category.title]).fetchone()
+    except psycopg.errors.UniqueViolation:
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"message": "Could not create duplicate category"})
+    _counts.delete("categories")
+    return row_out(row)
+
+
+@router.put(
+    "/api/categories/{category_id}",
+    response_model=CategoryOut,
+    responses={404: {"model": Message}},
+)
+def update_category_pg(category_id: int, category: CategoryIn, conn=Depends(get_pg)):
+    with conn.transaction():
+        row = conn.execute(UPDATE_CATEGORY, [category.title, category_id]).fetchone()
+    if row is None:
+        return not_found("Category not found")
+    return row_out(row)
+
+
+@router.delete(
+    "/api/categories/{category_id}",
+    response_model=Message,
+    responses={400: {"model": Message}},
+)
+def remove_category_pg(category_id: int, conn=Depends(get_pg)):
+    try:
+        with conn.transaction():
+            conn.execute(DELETE_CATEGORY, [category_id])
+    except psycopg.errors.ForeignKeyViolation:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Cannot delete category because it has clues"})
+    _counts.delete("categories")
+    return {"message": "Success"}
+
+
+@router.get("/api/games", response_model=Games)
+def games_list_pg(request: Request, response: Response, page: int = 0, after: Optional[int] = None, conn=Depends(get_pg)):
+    if after is not None:
+        rows = conn.execute(GAMES_AFTER, [after]).fetchall()
+    else:
+        rows = conn.execute(GAMES_PAGE, [100 * page]).fetchall()
+    page_count = count(conn, "games") // 100
+    not_modified = conditional.check(request, response, "game_list", row_etag("games", rows, page, after, page_count))
+    if not_modified:
+        return not_modified
+    return {
+        "page_count": page_count,
+        "games": [row_out(row) for row in rows],
+        "next_cursor": str(rows[-1]["id"]) if len(rows) == 100 else None,
+    }
+
+
+@router.get(
+    "/api/games/{game_id}",
+    response_model=GameOut,
+    responses={404: {"model": Message}},
+)
+def get_game_pg(game_id: int, request: Request, response: Response, conn=Depends(get_pg)):
+    row = conn.execute(GAME, [game_id]).fetchone()
+    if row is None:
+        return not_found("Game not found")
+    not_modified = conditional.check(request, response, "game", row_etag("game", [row]))
+    if not_modified:
+        return not_modified
+    return row_out(row)
@@ -0,0 +1,63 @@
+from datetime import datetime
+import os
+import random
+import threading
+
+refresh_seconds = float(os.environ.get('SAMPLER_REFRESH_SECONDS', 300))
+
+
+# In-process pool of clue ids matching a filter, refreshed in the
+# background. Picking from it is a uniform O(1) choice followed by an
+# _id lookup, instead of a $match + $sample over the filtered collection
+# (which cannot use $sample's random cursor).
+class IdPool:
+
+    def __init__(self, collection, query):
+        self.collection = collection
+        self.query = query
+        self.ids = []
+        self.refreshed_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self, db):
+        # Covered by the (invalid_count, _id) index, so no documents are read.
+        ids = [doc["_id"] for doc in db[self.collection].find(self.query, {"_id": 1})]
+        # Swapping the reference is atomic, readers never see a partial list.
+        self.ids = ids
+        self.refreshed_at = datetime.utcnow()
+
+    def choice(self):
+        ids = self.ids
+        if not ids:
+            return None
+        return random.choice(ids)
+
+    def start(self, get_db):
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.refresh(get_db())
+                except Exception:
+                    # Keep serving the previous ids, retry next round.
+                    pass
+                self._stop.wait(refresh_seconds)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name=f"{self.collection}-id-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def as_dict(self):
+        return {
+            "size": len(self.ids),
+            "refreshed_at": self.refreshed_at,
+        }
+
+
+valid_clues = IdPool("clues", {"invalid_count": {"$eq": 0}})
@@ -0,0 +1,170 @@
+# Category snapshots embedded in clue documents.
+#
+# Each clue carries {id, title, canon, version} of its category under
+# "category", so a clue read is a single document fetch. update_category
+# queues the new snapshot here; a background thread coalesces queued
+# changes per category every SNAPSHOT_PROPAGATE_SECONDS and writes each
+# with one update_many over the category's clues. Only snapshots of an
+# older version are overwritten, so a late or repeated write is harmless.
+#
+# Clues without a snapshot still get their category through
+# load_categories. stale() and repair() find and rewrite snapshots that
+# are missing or behind their category, e.g. after the loader:
+#
+#     python -m snapshots            # count stale snapshots
+#     python -m snapshots --repair   # and rewrite them
+from pymongo.errors import PyMongoError
+import argparse
+import os
+import sys
+import threading
+
+propagate_seconds = float(os.environ.get('SNAPSHOT_PROPAGATE_SECONDS', 1))
+
+_lock = threading.Lock()
+# category _id -> snapshot waiting to be written
+_queued = {}
+_wake = threading.Event()
+_stop = threading.Event()
+_thread = None
+_get_db = None
+stats = {"queued": 0, "propagated": 0, "clues": 0}
+
+
+def snapshot(category):
+    # From a category as cached by routers.categories (id already a str).
+    return {
+        "id": category["id"],
+        "title": category["title"],
+        "canon": category["canon"],
+        "version": category.get("version", 0),
+    }
+
+
+def queue(category_id, category):
+    with _lock:
+        _queued[category_id] = snapshot(category)
+        stats["queued"] += 1
+    _wake.set()
+
+
+def propagate(db):
+    with _lock:
+        batch = dict(_queued)
+        _queued.clear()
+    pending = list(batch.items())
+    for i, (category_id, category) in enumerate(pending):
+        try:
+            result = db.clues.update_many(
+                {"category_id": category_id, "category.version": {"$not": {"$gte": category["version"]}}},
+                {"$set": {"category": category}},
+            )
+        except PyMongoError:
+            # This category and the ones not tried yet go back for the
+            # next round, unless a newer change replaced them.
+            with _lock:
+                for category_id, category in pending[i:]:
+                    _queued.setdefault(category_id, category)
+            raise
+        with _lock:
+            stats["propagated"] += 1
+            stats["clues"] += result.modified_count
+    return len(batch)
+
+
+def start(get_db):
+    global _thread, _get_db
+    _get_db = get_db
+
+    def run():
+        while not _stop.is_set():
+            _wake.wait(propagate_seconds)
+            _wake.clear()
+            try:
+                propagate(get_db())
+            except Exception:
+                # The rest of the batch was queued again for the next round.
+                pass
+
+    _stop.clear()
+    _thread = threading.Thread(target=run, name="category-snapshots", daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+    if _get_db is not None:
+        propagate(_get_db())
+
+
+def as_dict():
+    with _lock:
+        result = dict(stats)
+        result["waiting"] = len(_queued)
+    return result
+
+
+def stale_pipeline():
+    # Clues whose snapshot is missing or differs from their category.
+    return [
+        {"$lookup": {"from": "categories", "localField": "category_id", "foreignField": "_id", "as": "current"}},
+        {"$unwind": "$current"},
+        # A missing snapshot compares as null.
+        {"$match": {"$expr": {"$or": [
+            {"$ne": [{"$ifNull": ["$category.title", None]}, "$current.title"]},
+            {"$ne": [{"$ifNull": ["$category.canon", None]}, "$current.canon"]},
+            {"$ne": [{"$ifNull": ["$category.version", 0]}, {"$ifNull": ["$current.version", 0]}]},
+        ]}}},
+    ]
+
+
+def stale(db):
+    counts = db.clues.aggregate(stale_pipeline() + [
+        {"$group": {"_id": None, "clues": {"$sum": 1}, "categories": {"$addToSet": "$category_id"}}},
+        {"$project": {"clues": 1, "categories": {"$size": "$categories"}}},
+    ], allowDiskUse=True)
+    for count in counts:
+        return {"clues": count["clues"], "categories": count["categories"]}
+    return {"clues": 0, "categories": 0}
+
+
+def repair(db):
+    # Rewrites every stale snapshot in one pass on the server.
+    db.clues.aggregate(stale_pipeline() + [
+        {"$project": {"category": {
+            "id": {"$toString": "$current._id"},
+            "title": "$current.title",
+            "canon": "$current.canon",
+            "version": {"$ifNull": ["$current.version", 0]},
+        }}},
+        {"$merge": {"into": "clues", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}},
+    ], allowDiskUse=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m snapshots")
+    parser.add_argument("--repair", action="store_true", help="rewrite stale snapshots")
+    args = parser.parse_args(argv)
+
+    from database import close, get_db
+
+    db = get_db()
+    try:
+        found = stale(db)
+        print(f"{found['clues']} stale clue snapshots in {found['categories']} categories")
+        if args.repair and found["clues"]:
+            repair(db)
+            found = stale(db)
+            print(f"after repair: {found['clues']} stale clue snapshots")
+    finally:
+        close()
+    return 1 if found["clues"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,58 @@
+# Runs the app against the in-memory stand-in used by the benchmarks:
+#
+#     cd api && python -m pytest tests
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGOHOST', 'localhost')
+os.environ.setdefault('MONGODATABASE', 'trivia-game-test')
+os.environ.setdefault('MONGOUSER', 'trivia-game')
+os.environ.setdefault('MONGOPASSWORD', 'trivia-game')
+
+
+@pytest.fixture(scope="session")
+def counter():
+    from benchmarks.commands import CommandCounter, in_memory_client
+    import database
+
+    counter = CommandCounter()
+    database.client = in_memory_client(counter)
+    return counter
+
+
+@pytest.fixture(scope="session")
+def db(counter):
+    from benchmarks.seed import seed
+    from indexes import ensure_indexes
+    import counters
+    import database
+
+    db = database.get_db()
+    seed(db, scale=0.002)
+    ensure_indexes(db)
+    counters.reconcile(db)
+    return db
+
+
+@pytest.fixture(scope="session")
+def client(db):
+    from fastapi.testclient import TestClient
+    import main
+
+    # No context manager, so startup does not start the background
+    # threads and their commands are not counted.
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def commands(counter, client):
+    # Commands issued by one request.
+    def commands(*args, **kwargs):
+        before = counter.count
+        response = client.get(*args, **kwargs)
+        assert response.status_code == 200
+        return counter.count - before
+    return commands
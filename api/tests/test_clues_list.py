@@ -0,0 +1,31 @@
+from routers.categories import category_cache
+import counters
+
+
+def cold():
+    category_cache.clear()
+    counters.invalidate()
+
+
+def test_clues_list_with_snapshots(commands):
+    # The clues find and the page count.
+    cold()
+    assert commands("/api/clues", params={"page": 1}) == 2
+    assert commands("/api/clues", params={"page": 1}) == 1
+
+
+def test_clues_list_without_snapshots(db, commands):
+    # A page of clues from many categories, none with a snapshot, costs
+    # one categories find between them.
+    page = [clue["_id"] for clue in db.clues.find({"invalid_count": 0}).sort("_id").skip(200).limit(100)]
+    db.clues.update_many({"_id": {"$in": page}}, {"$unset": {"category": ""}})
+    assert len(db.clues.distinct("category_id", {"_id": {"$in": page}})) > 1
+    cold()
+    assert commands("/api/clues", params={"page": 2}) == 3
+    assert commands("/api/clues", params={"page": 2}) == 1
+
+
+def test_clues_list_after_cursor(client, commands):
+    cursor = client.get("/api/clues", params={"page": 0}).json()["next_cursor"]
+    cold()
+    assert commands("/api/clues", params={"after": cursor}) == 2